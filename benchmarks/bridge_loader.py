@@ -0,0 +1,16 @@
+"""
+Helper to import hoymiles-ms-a2-to-mqtt.py from the benchmark scripts.
+The script name contains dashes, so it can not be imported with a plain import statement.
+"""
+
+import importlib.util
+import os
+
+BRIDGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hoymiles-ms-a2-to-mqtt.py")
+
+
+def load_bridge():
+    spec = importlib.util.spec_from_file_location("hoymiles_ms_a2_to_mqtt", BRIDGE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Hoymiles cloud endpoints used by the bridge
+(see the Bruno collection in hoymiles-api/), to measure the bridge offline.
+
+usage: python benchmarks/cloud_simulator.py --port 8080 --stations 10 --latency-ms 80 --error-rate 0.01
+then start the bridge with
+    HOYMILES_REGION_URL=http://127.0.0.1:8080 HOYMILES_API_URL=http://127.0.0.1:8080 HOYMILES_DATA_URL=http://127.0.0.1:8080
+
+The flow data contains an extra field "sim_ts" (unix time of the response),
+benchmarks/throughput.py uses it to measure the cloud to MQTT latency.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_PREFIX = "sim-token-"
+
+
+class SimulatorSettings:
+    def __init__(self, stations=1, devices_per_station=1, latency_ms=50, jitter_ms=0, error_rate=0.0, dly_rate=0.0):
+        self.stations = stations
+        self.devices_per_station = devices_per_station
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.dly_rate = dly_rate
+
+
+class SimulatorState:
+    """ Tokens, settings written through station_ctl/write_c and request counters. """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.requests = {}
+        self.station_settings = {}
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def new_token(self):
+        token = f"{TOKEN_PREFIX}{random.getrandbits(64):016x}"
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def valid_token(self, token):
+        with self.lock:
+            return token in self.tokens
+
+    def station_setting(self, sid):
+        with self.lock:
+            return self.station_settings.setdefault(sid, {"power": 800, "grid_charge": 0})
+
+
+def station_ids(settings):
+    return [100000 + index for index in range(settings.stations)]
+
+
+def device_ids(settings, sid):
+    return [sid * 10 + index for index in range(settings.devices_per_station)]
+
+
+def flow_response(sid):
+    # same shape as the README sample, with some noise on the battery power
+    power = round(random.uniform(-800, 800), 1)
+    if power >= 0:
+        flow = [{"i": 20, "o": 40, "v": power}, {"i": 10, "o": 20, "v": power}]
+    else:
+        flow = [{"i": 40, "o": 20, "v": -power}, {"i": 20, "o": 10, "v": -power}]
+    flow += [{"i": 1, "o": 40, "v": 252.0}, {"i": 40, "o": 2, "v": 6.2}]
+    return {"status": "0", "data": {
+        "flow": flow, "dly": 3000, "con": 1, "soc": round(random.uniform(10, 100), 1),
+        "power": {"pv": 0.0, "bat": abs(power), "grid": 6.2, "load": 252.0, "sp": 0.0},
+        "brs": 2, "bhs": 0, "ems": 0, "sim_ts": time.time()
+    }}
+
+
+def station_data_response(sid, request):
+    day = request.get("start_date") or date.today().isoformat()
+    return {"status": "0", "message": "success", "data": {
+        "today_eq": "1", "month_eq": "20", "year_eq": "104", "total_eq": "125", "real_power": "0",
+        "data_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "reflux_station_data": {
+            "start_date": day, "end_date": request.get("end_date") or day,
+            "pv_power": "0", "grid_power": "0", "load_power": "252", "bms_power": "245",
+            "bms_soc": "53.0", "pv_to_load_eq": "177", "meter_b_in_eq": "1159", "meter_b_out_eq": "2",
+            "bms_in_eq": str(random.randint(0, 3000)), "bms_out_eq": str(random.randint(0, 3000)), "flows": []
+        }
+    }}
+
+
+def inverter_response(device_id):
+    return {"status": "0", "message": "success", "data": {
+        "id": device_id, "sn": f"SIM{device_id}", "dsp_sw": 10304, "wifi_sw": 4870, "bms_sw": 16846080,
+        "warn_data": {"connect": True, "warn": False},
+        "real_data": {"bms_soc": "53.0", "bms_temp": str(round(random.uniform(15, 35), 1)), "bms_state": 0}
+    }}
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real cloud
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        state = self.server.state
+        settings = state.settings
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json({"status": "1", "message": "invalid json"}, 400)
+            return
+
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        if self.path.startswith("/burst/"):
+            endpoint = "flow"
+        state.count(endpoint)
+
+        delay = settings.latency_ms + random.uniform(0, settings.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if random.random() < settings.error_rate:
+            self.send_json({"status": "1", "message": "simulated error"}, random.choice((200, 500, 503)))
+            return
+
+        base_url = f"http://{self.headers.get('Host')}"
+        if endpoint == "region_c":
+            self.send_json({"status": "0", "data": {"login_url": base_url}})
+            return
+        if endpoint == "login_c":
+            self.send_json({"status": "0", "data": {"token": state.new_token()}})
+            return
+        if not state.valid_token(self.headers.get("Authorization")):
+            self.send_json({"status": "100", "message": "token invalid"})
+            return
+
+        sid = request.get("sid") or (request.get("data") or {}).get("sid")
+        if endpoint == "select_by_page_c":
+            page, page_size = int(request.get("page", 1)), int(request.get("page_size", 50))
+            sids = station_ids(settings)[(page - 1) * page_size:page * page_size]
+            station_list = [{"sid": station_sid, "name": f"Sim {station_sid}", "devices": [
+                {"id": station_sid, "type": 1, "devices": [{"id": device_id, "type": 6} for device_id in device_ids(settings, station_sid)]}
+            ]} for station_sid in sids]
+            self.send_json({"status": "0", "data": {"total": settings.stations, "list": station_list}})
+        elif endpoint == "get_sd_uri_c":
+            self.send_json({"status": "0", "data": {"uri": f"{base_url}/burst/{sid}"}})
+        elif endpoint == "flow":
+            if random.random() < settings.dly_rate:
+                self.send_json({"status": "0", "data": {"dly": 10000}})
+            else:
+                self.send_json(flow_response(sid))
+        elif endpoint == "real_g_c":
+            self.send_json(station_data_response(sid, request))
+        elif endpoint == "find_c":
+            self.send_json(inverter_response(request.get("id")))
+        elif endpoint == "write_c":
+            data = request.get("data") or {}
+            setting = state.station_setting(data.get("sid"))
+            if request.get("action") == 1503:
+                setting["grid_charge"] = int(data.get("enable", 0))
+            elif request.get("action") == 1513:
+                setting["power"] = data.get("power")
+            self.send_json({"status": "0", "message": "success", "data": {}})
+        elif endpoint == "read_c":
+            action = request.get("action")
+            self.send_json({"status": "0", "message": "success", "data": f"{action}-{sid}"})
+        elif endpoint == "setting_status_c":
+            action, _, setting_sid = str(request.get("id", "")).partition("-")
+            setting = state.station_setting(int(setting_sid) if setting_sid.isdigit() else setting_sid)
+            if action == "1503":
+                self.send_json({"status": "0", "data": {"code": 0, "data": {"enable": setting["grid_charge"]}}})
+            else:
+                self.send_json({"status": "0", "data": {"code": 0, "data": {"power": setting["power"]}}})
+        else:
+            self.send_json({"status": "1", "message": f"unknown endpoint {self.path}"}, 404)
+
+
+def start_simulator(settings, host="127.0.0.1", port=0):
+    """ Starts the simulator in a background thread, returns the server (server.server_port, server.state). """
+    server = ThreadingHTTPServer((host, port), SimulatorHandler)
+    server.daemon_threads = True
+    server.state = SimulatorState(settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Hoymiles cloud simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--stations", type=int, default=1)
+    parser.add_argument("--devices-per-station", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with an error (0..1)")
+    parser.add_argument("--dly-rate", type=float, default=0.0, help="share of flow requests answered with dly 10000 (0..1)")
+    args = parser.parse_args()
+
+    settings = SimulatorSettings(args.stations, args.devices_per_station, args.latency_ms, args.jitter_ms, args.error_rate, args.dly_rate)
+    server = start_simulator(settings, args.host, args.port)
+    print(f"Hoymiles cloud simulator listening on http://{args.host}:{server.server_port} with {args.stations} station(s)")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"requests: {server.state.requests}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
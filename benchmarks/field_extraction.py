@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the field extraction: the compiled FIELDS accessors of the bridge
+against jsonpath_ng, parsed on every call (the previous implementation) and pre-parsed.
+
+usage: python benchmarks/field_extraction.py [iterations]
+jsonpath-ng is only needed for the comparison: pip install jsonpath-ng
+"""
+
+import sys
+import timeit
+
+from bridge_loader import load_bridge
+
+# Samples from the README
+SAMPLES = {
+    "flow": {'status': '0', 'data': {'flow': [{'i': 40, 'o': 20, 'v': 245.8}, {'i': 1, 'o': 40, 'v': 252.0}, {'i': 40, 'o': 2, 'v': 6.2}, {'i': 20, 'o': 10, 'v': 245.8}], 'dly': 3000, 'con': 1, 'soc': 53.0, 'power': {'pv': 0.0, 'bat': 245.8, 'grid': 6.2, 'load': 252.0, 'sp': 0.0}, 'brs': 2, 'bhs': 0, 'ems': 0}},
+    "station": {'status': '0', 'message': 'success', 'data': {'is_null': 0, 'today_eq': '1', 'month_eq': '20', 'year_eq': '104', 'total_eq': '125', 'real_power': '0', 'data_time': '2025-02-06 15:12:30', 'reflux_station_data': {'start_date': '2025-02-06', 'end_date': '2025-02-06', 'pv_power': '0', 'grid_power': '0', 'load_power': '0', 'bms_power': '0', 'bms_soc': '10.0', 'bms_in_eq': '285', 'bms_out_eq': '641', 'flows': [], 'mb_in_eq': {'today_eq': '0', 'month_eq': '0', 'year_eq': '0', 'total_eq': '0'}}}},
+    "inverter": {'status': '0', 'message': 'success', 'data': {'id': 3423, 'sn': 'xxx', 'dsp_sw': 10304, 'wifi_sw': 4870, 'bms_sw': 16846080, 'warn_data': {'connect': True, 'warn': False}, 'real_data': {'bms_soc': '10.0', 'bms_temp': '22.0', 'bms_state': 0}}},
+    "stations": {'status': '0', 'data': {'total': 1, 'list': [{'sid': 1234, 'devices': [{'id': 1, 'type': 1, 'devices': [{'id': 3423, 'type': 6}]}]}]}}
+}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    bridge = load_bridge()
+
+    try:
+        from jsonpath_ng import parse
+    except ImportError:
+        parse = None
+        print("jsonpath-ng not installed, only the compiled accessors are measured.")
+
+    print(f"{'response':10} {'method':22} {'us/call':>10}")
+    for response_type, document in SAMPLES.items():
+        paths = bridge.FIELDS[response_type]
+
+        def compiled():
+            return bridge.extract_fields(response_type, document)
+
+        results = {"compiled": compiled}
+        if parse is not None:
+            def parse_every_call():
+                return {name: [match.value for match in parse(path).find(document)] for name, path in paths.items()}
+
+            parsed = {name: parse(path) for name, path in paths.items()}
+
+            def pre_parsed():
+                return {name: [match.value for match in expr.find(document)] for name, expr in parsed.items()}
+
+            results["jsonpath parse per call"] = parse_every_call
+            results["jsonpath pre-parsed"] = pre_parsed
+
+        for method, func in results.items():
+            number = iterations if method == "compiled" else max(1, iterations // 20)
+            seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+            print(f"{response_type:10} {method:22} {seconds * 1e6:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the flow graph decoder (decode_flow) of the bridge: time and memory
+blocks allocated per call for the README sample and for flow arrays with more paths
+(known and unknown node pairs), to keep the decode of every flow poll cheap when paths are added.
+
+usage: python benchmarks/flow_decoder.py [iterations]
+"""
+
+import sys
+import timeit
+import tracemalloc
+
+from bridge_loader import load_bridge
+
+# flow array of the README sample: battery discharging, home load from the AC bus, a little grid import
+SAMPLE_FLOW = [{'i': 40, 'o': 20, 'v': 245.8}, {'i': 1, 'o': 40, 'v': 252.0}, {'i': 40, 'o': 2, 'v': 6.2}, {'i': 20, 'o': 10, 'v': 245.8}]
+
+
+def synthetic_flow(bridge, size):
+    """ Flow array with size entries, cycling through the known paths and some unknown node pairs. """
+    pairs = list(bridge.FLOW_PATHS) + [(3, 40), (40, 50), (50, 1)]
+    return [{'i': sink, 'o': source, 'v': float(index % 800)} for index, (source, sink) in
+            ((index, pairs[index % len(pairs)]) for index in range(size))]
+
+
+def allocated_blocks(func, calls=1000):
+    """ Memory blocks still allocated by func on average per call (0 = no leak, the result dict is reused). """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(calls):
+        func()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.count_diff for stat in after.compare_to(before, "filename")) / calls
+
+
+def peak_bytes(func):
+    """ Peak memory of a single call in bytes. """
+    func()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bridge = load_bridge()
+    bridge.log_flow.disabled = True  # unknown paths of the synthetic flows are logged once
+
+    flows = {"README sample": SAMPLE_FLOW}
+    for size in (8, 16, 32):
+        flows[f"{size} entries"] = synthetic_flow(bridge, size)
+
+    print(f"{'flow':16} {'us/call':>10} {'peak bytes':>12} {'blocks kept':>12}")
+    for name, flow in flows.items():
+        values = {}
+
+        def decode():
+            return bridge.decode_flow(flow, values)
+
+        seconds = min(timeit.repeat(decode, number=iterations, repeat=3)) / iterations
+        print(f"{name:16} {seconds * 1e6:10.2f} {peak_bytes(decode):12} {allocated_blocks(decode):12.2f}")
+
+
+if __name__ == "__main__":
+    main()
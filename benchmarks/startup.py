@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: starts the bridge against benchmarks/cloud_simulator.py and a local
+MQTT broker (e.g. mosquitto) and measures the time from the process start to the first
+availability message, the first value (restored from the state file on a warm start)
+and the first polled sample. The first run starts without a state file (cold), the
+following ones reuse the state file of the previous run (warm).
+
+usage: python benchmarks/startup.py --broker 127.0.0.1 --runs 3 --latency-ms 150
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from bridge_loader import BRIDGE_PATH
+from cloud_simulator import SimulatorSettings, start_simulator
+
+
+class FirstMessages:
+    """ Records the arrival time of the first availability message, the first value and the first polled sample. """
+
+    def __init__(self, broker, port, topic):
+        self.topic = topic
+        self.lock = threading.Lock()
+        self.times = {}
+        self.started_wall = time.time()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect = lambda client, userdata, flags, reason_code, properties: client.subscribe(f"{topic}/#")
+        self.client.on_message = self.on_message
+        self.client.connect(broker, port, 60)
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        received = time.monotonic()
+        stage = None
+        if message.topic == f"{self.topic}/bridge/availability":
+            stage = "availability" if message.payload == b"online" else None
+        elif message.topic == f"{self.topic}/flow":
+            stage = "value"
+            try:
+                # the simulator adds the response time, restored values are older than the process
+                if json.loads(message.payload)["data"]["sim_ts"] >= self.started_wall:
+                    self.record("sample", received)
+            except (ValueError, KeyError, TypeError):
+                pass
+        if stage:
+            self.record(stage, received)
+
+    def record(self, stage, received):
+        with self.lock:
+            self.times.setdefault(stage, received)
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+        self.started_wall = time.time()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bridge startup benchmark against the cloud simulator")
+    parser.add_argument("--broker", default="127.0.0.1")
+    parser.add_argument("--broker-port", type=int, default=1883)
+    parser.add_argument("--runs", type=int, default=3, help="bridge starts, the first one without state file")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for the first sample of a run")
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--env", action="append", default=[], help="extra bridge setting, e.g. --env PAYLOAD_MODE=flat")
+    args = parser.parse_args()
+
+    simulator = start_simulator(SimulatorSettings(1, 1, args.latency_ms))
+    simulator_url = f"http://127.0.0.1:{simulator.server_port}"
+    topic = f"hoymiles-startup-{os.getpid()}"
+    collector = FirstMessages(args.broker, args.broker_port, topic)
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ)
+        env.update({
+            "HOYMILES_USER": "bench@example.com",
+            "HOYMILES_PASSWORD": "bench",
+            "HOYMILES_REGION_URL": simulator_url,
+            "HOYMILES_API_URL": simulator_url,
+            "HOYMILES_DATA_URL": simulator_url,
+            "MQTT_BROKER": args.broker,
+            "MQTT_PORT": str(args.broker_port),
+            "MQTT_TOPIC": topic,
+            "PAYLOAD_MODE": "raw",
+            "STATE_FILE": os.path.join(temp_dir, "bench.state"),
+            "STATE_FLUSH_SECONDS": "1",
+            "BUFFER_FILE": os.path.join(temp_dir, "bench.buffer"),
+            "TOKEN_CACHE_FILE": os.path.join(temp_dir, "bench.token"),
+            "AUTH_RATE_PER_MINUTE": "0",
+            "DEBUG": "false"
+        })
+        for entry in args.env:
+            key, _, value = entry.partition("=")
+            env[key.upper()] = value
+
+        try:
+            for run in range(args.runs):
+                collector.reset()
+                start = time.monotonic()
+                bridge = subprocess.Popen([sys.executable, BRIDGE_PATH], env=env)
+                deadline = start + args.timeout
+                while "sample" not in collector.times and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                time.sleep(1.5)  # lets the state file be written for the next run
+                bridge.terminate()
+                bridge.wait(10)
+                with collector.lock:
+                    times = {stage: received - start for stage, received in collector.times.items()}
+                results.append(("cold" if run == 0 else "warm", times))
+        finally:
+            collector.stop()
+            simulator.shutdown()
+
+    print(f"{'run':<6} {'availability':>14} {'first value':>14} {'first sample':>14}")
+    for kind, times in results:
+        cells = [f"{times[stage] * 1000:.0f} ms" if stage in times else "-" for stage in ("availability", "value", "sample")]
+        print(f"{kind:<6} {cells[0]:>14} {cells[1]:>14} {cells[2]:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput benchmark: runs the bridge against benchmarks/cloud_simulator.py
+and a local MQTT broker (e.g. mosquitto) and reports polls per second, cloud to MQTT
+latency (p50/p99), CPU time and RSS of the bridge process.
+
+usage: python benchmarks/throughput.py --broker 127.0.0.1 --stations 20 --duration 60 --interval 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from bridge_loader import BRIDGE_PATH
+from cloud_simulator import SimulatorSettings, start_simulator
+
+
+class LatencyCollector:
+    """ Subscribes to the flow topics of the bridge and measures the latency from the simulator response to MQTT. """
+
+    def __init__(self, broker, port, topic):
+        self.topic = topic
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.messages = 0
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect = lambda client, userdata, flags, reason_code, properties: client.subscribe(f"{topic}/#")
+        self.client.on_message = self.on_message
+        self.client.connect(broker, port, 60)
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        received = time.time()
+        with self.lock:
+            self.messages += 1
+        if not message.topic.endswith("/flow"):
+            return
+        try:
+            sim_ts = json.loads(message.payload)["data"]["sim_ts"]
+        except (ValueError, KeyError, TypeError):
+            return
+        with self.lock:
+            self.latencies.append(received - sim_ts)
+
+    def reset(self):
+        with self.lock:
+            self.latencies = []
+            self.messages = 0
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def read_process_usage(pid):
+    """ Returns (cpu seconds, rss in MB) of a process from /proc (Linux only), or (None, None). """
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as file:
+            rss_kb = next(int(line.split()[1]) for line in file if line.startswith("VmRSS:"))
+        return cpu_seconds, rss_kb / 1024
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None, None
+
+
+def percentile(values, share):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bridge throughput benchmark against the cloud simulator")
+    parser.add_argument("--broker", default="127.0.0.1")
+    parser.add_argument("--broker-port", type=int, default=1883)
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="measured seconds (after the warmup)")
+    parser.add_argument("--warmup", type=float, default=10)
+    parser.add_argument("--interval", type=int, default=5, help="request_interval_seconds of the bridge")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--dly-rate", type=float, default=0.0)
+    parser.add_argument("--env", action="append", default=[], help="extra bridge setting, e.g. --env POLL_WORKERS=8")
+    args = parser.parse_args()
+
+    settings = SimulatorSettings(args.stations, 1, args.latency_ms, args.jitter_ms, args.error_rate, args.dly_rate)
+    simulator = start_simulator(settings)
+    simulator_url = f"http://127.0.0.1:{simulator.server_port}"
+    topic = f"hoymiles-bench-{os.getpid()}"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ)
+        env.update({
+            "HOYMILES_USER": "bench@example.com",
+            "HOYMILES_PASSWORD": "bench",
+            "HOYMILES_REGION_URL": simulator_url,
+            "HOYMILES_API_URL": simulator_url,
+            "HOYMILES_DATA_URL": simulator_url,
+            "MQTT_BROKER": args.broker,
+            "MQTT_PORT": str(args.broker_port),
+            "MQTT_TOPIC": topic,
+            "REQUEST_INTERVAL_SECONDS": str(args.interval),
+            "POLL_JITTER_SECONDS": "0",
+            "PAYLOAD_MODE": "raw",
+            "PUBLISH_ON_CHANGE": "false",
+            "STATE_FILE": os.path.join(temp_dir, "bench.state"),
+            "BUFFER_FILE": os.path.join(temp_dir, "bench.buffer"),
+            "TOKEN_CACHE_FILE": os.path.join(temp_dir, "bench.token"),
+            "AUTH_RATE_PER_MINUTE": "0",
+            "DEBUG": "false"
+        })
+        for entry in args.env:
+            key, _, value = entry.partition("=")
+            env[key.upper()] = value
+
+        collector = LatencyCollector(args.broker, args.broker_port, topic)
+        bridge = subprocess.Popen([sys.executable, BRIDGE_PATH], env=env)
+        try:
+            time.sleep(args.warmup)
+            collector.reset()
+            start_requests = dict(simulator.state.requests)
+            start_cpu, _ = read_process_usage(bridge.pid)
+            time.sleep(args.duration)
+            end_cpu, rss_mb = read_process_usage(bridge.pid)
+            with collector.lock:
+                latencies = list(collector.latencies)
+                messages = collector.messages
+            requests = {endpoint: count - start_requests.get(endpoint, 0) for endpoint, count in simulator.state.requests.items()}
+        finally:
+            bridge.terminate()
+            bridge.wait(10)
+            collector.stop()
+            simulator.shutdown()
+
+    print(f"stations:              {args.stations}")
+    print(f"measured seconds:      {args.duration}")
+    # the simulator answers with dly 3000, the bridge does not poll a station faster than that
+    print(f"polls per second:      {len(latencies) / args.duration:.2f} (expected {args.stations / max(args.interval, 3):.2f})")
+    print(f"mqtt messages/second:  {messages / args.duration:.2f}")
+    print(f"latency p50:           {percentile(latencies, 0.5) * 1000:.1f} ms")
+    print(f"latency p99:           {percentile(latencies, 0.99) * 1000:.1f} ms")
+    if latencies:
+        print(f"latency mean:          {statistics.mean(latencies) * 1000:.1f} ms")
+    if start_cpu is not None and end_cpu is not None:
+        print(f"bridge cpu:            {(end_cpu - start_cpu) / args.duration * 100:.1f} % of one core")
+        print(f"bridge rss:            {rss_mb:.1f} MB")
+    print(f"cloud requests:        {requests}")
+
+
+if __name__ == "__main__":
+    main()
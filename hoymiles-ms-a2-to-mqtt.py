@@ -2,13 +2,39 @@
 
 import hashlib
 import base64
-import requests
-import paho.mqtt.client as mqtt
 import os
+import sys
 import json
 import time
-from datetime import datetime
-from jsonpath_ng import parse
+import logging
+import asyncio
+import random
+import threading
+import sqlite3
+import gzip
+import collections
+import argparse
+import re
+import bisect
+import math
+import tempfile
+import signal
+import abc
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the token is then not shared between processes
+    fcntl = None
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, datetime, timedelta
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+startup_started = time.monotonic()
+
+# requests and paho are imported on first use (create_http_session, create_mqtt_client):
+# the bridge connects to the broker and publishes the saved state while requests is still loading
+requests = None
+mqtt = None
 
 # Function to load configuration variables from a file
 def load_config(config_file):
@@ -20,12 +46,6 @@ def load_config(config_file):
                 config[key.strip()] = value.strip()
     return config
 
-# Function to save configuration variables to a file
-def save_config(config_file, config):
-    with open(config_file, "w") as file:
-        for key, value in config.items():
-            file.write(f"{key}={value}\n")
-
 # Load configuration variables
 config_file = os.path.join(os.path.dirname(__file__), "hoymiles-ms-a2-to-mqtt.config")
 config = load_config(config_file)
@@ -41,42 +61,124 @@ mqtt_broker       = get_config_var("mqtt_broker")
 mqtt_user         = get_config_var("mqtt_user")
 mqtt_password     = get_config_var("mqtt_password")
 mqtt_topic        = get_config_var("mqtt_topic")
-token             = get_config_var("token", None)
-login_url         = get_config_var("login_url", None)
-sid               = get_config_var("sid", None)
-inverterId        = get_config_var("inverterId", None)
-uri               = None
+
+# Hoymiles cloud hosts (can be pointed to benchmarks/cloud_simulator.py)
+hoymiles_region_url = get_config_var("hoymiles_region_url", "https://euapi.hoymiles.com")
+hoymiles_api_url    = get_config_var("hoymiles_api_url", "https://neapi.hoymiles.com")
+hoymiles_data_url   = get_config_var("hoymiles_data_url", "https://eud0.hoymiles.com")
 
 # 
 debug = get_config_var("debug", "false").lower() == "true"
 
-# Function to print debug messages (if debug is enabled)
-def debug_print(message):
-    if debug:
-        #timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        #print(f"[{timestamp}] {message}")
-        print(f"{message}")
+# Logging: log_level (debug, info, warning, error), debug=true is the same as log_level=debug
+# log_levels overrides single subsystems, e.g. "flow:debug,mqtt:warning"
+# log_format text or json (one json object per line)
+# the same warning/error is logged at most once per log_rate_limit_seconds
+log_level  = get_config_var("log_level", "debug" if debug else "info").upper()
+log_levels = get_config_var("log_levels", "")
+log_format = get_config_var("log_format", "text").lower()
+log_rate_limit_seconds = 60
+try:
+    log_rate_limit_seconds = int(get_config_var("log_rate_limit_seconds", log_rate_limit_seconds))
+except ValueError:
+    pass
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets a repeated warning or error (same logger and message template) through once per interval,
+    the next one that is logged tells how many were dropped in between.
+    """
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.seen = {}  # (logger, template) -> [last logged, suppressed]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry else 0
+            self.seen[key] = [now, 0]
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar message(s) suppressed)"
+        return True
+
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter(log_rate_limit_seconds))
+    root = logging.getLogger("hoymiles")
+    root.addHandler(handler)
+    root.propagate = False
+    try:
+        root.setLevel(log_level)
+    except ValueError:
+        root.setLevel(logging.INFO)
+        root.warning("Invalid value for 'log_level' in config, defaulting to info.")
+    for entry in log_levels.split(","):
+        if not entry.strip():
+            continue
+        try:
+            name, level = entry.split(":", 1)
+            logging.getLogger(f"hoymiles.{name.strip()}").setLevel(level.strip().upper())
+        except ValueError:
+            root.warning("Invalid entry '%s' in 'log_levels', ignoring it.", entry)
 
+setup_logging()
 
-# Initialize last station data fetch time
-last_station_data_time = 0
+# one logger per subsystem (log_levels uses the part after "hoymiles.")
+log          = logging.getLogger("hoymiles")
+log_auth     = logging.getLogger("hoymiles.auth")
+log_http     = logging.getLogger("hoymiles.http")
+log_flow     = logging.getLogger("hoymiles.flow")
+log_station  = logging.getLogger("hoymiles.station")
+log_inverter = logging.getLogger("hoymiles.inverter")
+log_mqtt     = logging.getLogger("hoymiles.mqtt")
+log_poll     = logging.getLogger("hoymiles.poll")
+log_control  = logging.getLogger("hoymiles.control")
 
 
 # Load request interval with validation
 request_interval_seconds = 60  # Default value
 try:
     request_interval_seconds = int(get_config_var("request_interval_seconds", request_interval_seconds))
-    debug_print(f"Request Interval in Seconds: {request_interval_seconds}")
+    log.debug("Request Interval in Seconds: %s", request_interval_seconds)
 except ValueError:
-    debug_print(f"Invalid value for 'request_interval_seconds' in config, defaulting to {request_interval_seconds} seconds.")
+    log.warning("Invalid value for 'request_interval_seconds' in config, defaulting to %s seconds.", request_interval_seconds)
 
 # Load station interval with validation
 station_data_interval = 3600  # 1 hour in seconds
 try:
     station_data_interval = int(get_config_var("station_data_interval", station_data_interval))
-    debug_print(f"Station Data Interval in Seconds: {station_data_interval}")
+    log.debug("Station Data Interval in Seconds: %s", station_data_interval)
 except ValueError:
-    debug_print(f"Invalid value for 'station_data_interval' in config, defaulting to {station_data_interval} seconds.")
+    log.warning("Invalid value for 'station_data_interval' in config, defaulting to %s seconds.", station_data_interval)
 
 
 # Load port with validation
@@ -84,129 +186,1727 @@ mqtt_port = 1883  # Default value
 try:
     mqtt_port = int(get_config_var("mqtt_port", mqtt_port))
 except ValueError:
-    debug_print(f"Invalid value for 'mqtt_port' in config, defaulting to {mqtt_port} seconds.")
+    log.warning("Invalid value for 'mqtt_port' in config, defaulting to %s.", mqtt_port)
+
+# Function to load an integer config variable with validation
+def get_int_config_var(key, default):
+    try:
+        return int(get_config_var(key, default))
+    except ValueError:
+        log.warning("Invalid value for '%s' in config, defaulting to %s.", key, default)
+        return default
+
+http_pool_maxsize    = get_int_config_var("http_pool_maxsize", 4)       # keep-alive connections per host
+http_retries         = get_int_config_var("http_retries", 2)            # retries on connection errors and 502/503/504
+http_timeout_seconds = get_int_config_var("http_timeout_seconds", 10)
+
+# Inverter data has its own cadence, by default the same as the station data
+inverter_data_interval = get_int_config_var("inverter_data_interval", station_data_interval)
+
+# Scheduler: random delay added to every tick and the upper limit of the error backoff
+poll_jitter_seconds = get_int_config_var("poll_jitter_seconds", 1)
+max_backoff_seconds = get_int_config_var("max_backoff_seconds", 300)
+
+# Live energy counters: intervals between two flow samples longer than energy_max_gap_seconds are not integrated
+energy_max_gap_seconds = get_int_config_var("energy_max_gap_seconds", 300)
+
+def parse_timezone(name):
+    if not name:
+        if not os.environ.get("TZ") and time.timezone == 0 and not time.daylight:
+            log.warning("No 'timezone' set and the system runs on UTC, the days of the live energy start at midnight UTC.")
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        log.warning("Invalid value '%s' for 'timezone' in config, using the local time of the system: %s", name, e)
+        return None
+
+# Time zone of the stations (e.g. Europe/Berlin), the cloud reports data_time and the days in it (empty = local time of the system)
+station_timezone = parse_timezone(get_config_var("timezone", ""))
+
+def station_day(timestamp):
+    """ Day (date) of a unix time in the time zone of the stations. """
+    return datetime.fromtimestamp(timestamp, station_timezone).date()
+
+def station_time(day, text="00:00:00"):
+    """ Unix time of a local time of the stations, e.g. station_time("2025-02-06", "15:12:30"). """
+    return datetime.strptime(f"{day} {text}", "%Y-%m-%d %H:%M:%S").replace(tzinfo=station_timezone).timestamp()
+
+# A feed is stale (<feed topic>/availability offline) after stale_after_intervals intervals without a good sample
+stale_after_intervals = max(1, get_int_config_var("stale_after_intervals", 3))
+
+# Change-only publishing: unchanged values (or changes within the deadband of a topic)
+# are not published again, but at least every publish_heartbeat_seconds
+publish_on_change = get_config_var("publish_on_change", "true").lower() == "true"
+publish_heartbeat_seconds = get_int_config_var("publish_heartbeat_seconds", 300)
+
+# Function to parse deadbands like "power-battery:5,soc:0.5" (keyed by the last topic level)
+def parse_deadbands(value):
+    deadbands = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        try:
+            name, deadband = entry.split(":", 1)
+            deadbands[name.strip()] = float(deadband)
+        except ValueError:
+            log.warning("Invalid entry '%s' in 'publish_deadbands', ignoring it.", entry)
+    return deadbands
+
+publish_deadbands = parse_deadbands(get_config_var("publish_deadbands", ""))
+
+# MQTT delivery: QoS of all messages, per topic QoS and retain like "soc:1:retain,flow:1" (keyed by the last topic level),
+# size of the publish queue (full queue: samples go to the buffer) and the upper limit of the reconnect backoff
+mqtt_qos = get_int_config_var("mqtt_qos", 0)
+mqtt_max_queued = get_int_config_var("mqtt_max_queued", 1000)
+mqtt_reconnect_max_seconds = get_int_config_var("mqtt_reconnect_max_seconds", 120)
+
+# Function to parse topic options like "soc:1:retain,flow:1"
+def parse_topic_options(value):
+    options = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        try:
+            name, qos, *flags = [part.strip() for part in entry.split(":")]
+            if int(qos) not in (0, 1, 2) or any(flag != "retain" for flag in flags):
+                raise ValueError(entry)
+            options[name] = (int(qos), "retain" in flags)
+        except ValueError:
+            log.warning("Invalid entry '%s' in 'mqtt_topic_options', ignoring it.", entry)
+    return options
+
+mqtt_topic_options = parse_topic_options(get_config_var("mqtt_topic_options", ""))
+
+# Function to parse cache times like "real_g_c:300,find_c:600" (keyed by endpoint)
+def parse_cache_ttls(value):
+    ttls = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        try:
+            endpoint, ttl = entry.split(":", 1)
+            ttls[endpoint.strip()] = max(0, int(ttl))
+        except ValueError:
+            log.warning("Invalid entry '%s' in 'response_cache_ttl', ignoring it.", entry)
+    return ttls
+
+# Response cache of the slow-changing endpoints: seconds a response is used without a new request
+# (0 = always requested), at most response_cache_size responses; unchanged responses are not published again
+response_cache_ttls = {"real_g_c": 0, "find_c": 0}
+response_cache_ttls.update(parse_cache_ttls(get_config_var("response_cache_ttl", "")))
+response_cache_size = get_int_config_var("response_cache_size", 256)
+
+# Seconds between two requests of the station list, added or removed stations and devices restart the feeds (0 = never)
+station_refresh_seconds = get_int_config_var("station_refresh_seconds", 3600)
+
+# Payload mode of the station and inverter data (and the raw flow data):
+#   raw:  full cloud responses on /flow, /station and /inverter (default)
+#   flat: only the values used by the sensors, one topic per value
+#   json: only the values used by the sensors, as small json object on /flow, /station and /inverter
+payload_mode = get_config_var("payload_mode", "raw").lower()
+if payload_mode not in ("raw", "flat", "json"):
+    log.warning("Invalid value for 'payload_mode' in config, defaulting to raw.")
+    payload_mode = "raw"
+# in flat and json mode the full responses can still be published to mqtt_topic/debug/...
+publish_raw = get_config_var("publish_raw", "false").lower() == "true"
+
+# Token and burst uri are renewed in the background after these ages
+token_refresh_seconds = get_int_config_var("token_refresh_seconds", 86400)
+uri_refresh_seconds   = get_int_config_var("uri_refresh_seconds", 1800)
+
+# Token shared by all bridge processes of the account (a file in a private directory, or a shared volume
+# in containers), empty = not shared. The token in the file is trusted, nobody else may be able to write there.
+token_cache_file = get_config_var("token_cache_file", "")
+
+# Rate limit of the auth requests (region, login) of this process: auth_rate_per_minute, bursts of auth_burst
+auth_rate_per_minute = get_int_config_var("auth_rate_per_minute", 6)
+auth_burst = get_int_config_var("auth_burst", 3)
+
+# Runtime state file (token, stations, uris), separate from this configuration
+state_file = get_config_var("state_file", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hoymiles-ms-a2-to-mqtt.state"))
+state_flush_seconds = get_int_config_var("state_flush_seconds", 10)
+# Values that change with every sample (last values, live energy, last sample times) are kept in
+# memory and written to sample_state_file only every sample_state_flush_seconds and when the bridge stops
+sample_state_file = get_config_var("sample_state_file", f"{state_file}.values")
+sample_state_flush_seconds = get_int_config_var("sample_state_flush_seconds", 900)
+
+# Samples that could not be published while the broker was unreachable are kept in buffer_file
+# (up to buffer_max_mb, oldest dropped first, 0 = disabled) and replayed to mqtt_topic/replay/...
+# with their original timestamps, at most buffer_replay_rate messages per second
+buffer_file = get_config_var("buffer_file", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hoymiles-ms-a2-to-mqtt.buffer"))
+buffer_max_mb = get_int_config_var("buffer_max_mb", 16)
+buffer_replay_rate = get_int_config_var("buffer_replay_rate", 20)
+
+# Sinks of the decoded samples besides the MQTT topics (empty = off): InfluxDB line protocol over HTTP
+# (influx_url, e.g. http://influxdb:8086/api/v2/write?org=home&bucket=hoymiles, with influx_token) or into a file
+# (influx_file), gzip compressed NDJSON rotated after ndjson_rotate_mb (ndjson_file, ndjson_keep rotated files)
+# and one json record per sample on records_topic. Every sink has its own queue (<sink>_queue_size), batches
+# (<sink>_batch_size) and flush interval (<sink>_flush_seconds), e.g. influx_flush_seconds=30
+influx_url = get_config_var("influx_url", "")
+influx_token = get_config_var("influx_token", "")
+influx_file = get_config_var("influx_file", "")
+ndjson_file = get_config_var("ndjson_file", "")
+ndjson_rotate_mb = get_int_config_var("ndjson_rotate_mb", 16)
+ndjson_keep = get_int_config_var("ndjson_keep", 10)
+records_topic = get_config_var("records_topic", "")
+
+# Metrics: Prometheus endpoint on metrics_port (0 = disabled) and json stats on mqtt_topic/bridge/stats
+metrics_port = get_int_config_var("metrics_port", 0)
+metrics_bind = get_config_var("metrics_bind", "0.0.0.0")
+stats_interval_seconds = get_int_config_var("stats_interval_seconds", 60)
+
+# Number of stations/devices polled at the same time
+poll_workers = get_int_config_var("poll_workers", 4)
+
+# Deadlines for the concurrent fetches of one poll
+flow_deadline_seconds     = get_int_config_var("flow_deadline_seconds", 15)
+station_deadline_seconds  = get_int_config_var("station_deadline_seconds", 15)
+inverter_deadline_seconds = get_int_config_var("inverter_deadline_seconds", 15)
+
+# Home Assistant discovery prefix (birth messages are expected on <prefix>/status)
+discovery_prefix = get_config_var("discovery_prefix", "homeassistant")
+
+# "online" while the bridge runs, "offline" (last will) when it stops or loses the broker connection
+availability_topic = f"{mqtt_topic}/bridge/availability"
+
+FEED_INTERVALS = {"flow": request_interval_seconds, "station": station_data_interval, "inverter": inverter_data_interval}
+
+def stale_seconds(interval):
+    # the last interval may end with a slow request
+    return stale_after_intervals * max(1, interval) + http_timeout_seconds
+
+def expire_after(feed):
+    """ Seconds until Home Assistant expires a value of the feed: the stale time plus the heartbeat of unchanged values. """
+    return stale_seconds(FEED_INTERVALS[feed]) + (publish_heartbeat_seconds if publish_on_change else 0)
+
+# The last values of every feed are saved in sample_state_file and published again right after a
+# restart, if they are not older than last_values_max_age_seconds (0 = not saved)
+last_values_max_age_seconds = get_int_config_var("last_values_max_age_seconds", 900)
+
+# Station settings through MQTT commands (mqtt_topic/set/grid-charge, mqtt_topic/set/grid-power),
+# a burst of commands is sent once after command_debounce_seconds without a newer one,
+# a written setting is read back for at most command_confirm_seconds
+enable_commands = get_config_var("enable_commands", "false").lower() == "true"
+command_debounce_seconds = get_int_config_var("command_debounce_seconds", 2)
+command_confirm_seconds = get_int_config_var("command_confirm_seconds", 20)
+grid_power_max = get_int_config_var("grid_power_max", 2000)
+
+
+class StateStore:
+    """
+    Runtime state (token, login url, stations, burst uris and their issue times),
+    kept apart from the configuration with the secrets.
+    The file is read on first access. Changes are collected in memory and written
+    at most every flush_seconds, atomically (temp file, fsync, rename).
+    If the file can not be written (e.g. read-only filesystem) the state stays in memory.
+    """
+
+    def __init__(self, path, flush_seconds):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.data = None
+        self.dirty = False
+        self.write_failed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.data is None:
+            self.data = {}
+            try:
+                with open(self.path, "r") as file:
+                    self.data = json.load(file)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                log.warning("Could not read state file %s: %s", self.path, e)
+        return self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.load().get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            data = self.load()
+            if data.get(key) != value:
+                data[key] = value
+                self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = json.dumps(self.data)
+            self.dirty = False
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as file:
+                file.write(snapshot)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            try:
+                dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError:
+                pass  # not supported on every platform
+            self.write_failed = False
+        except OSError as e:
+            if not self.write_failed:
+                log.warning("Could not write state file %s, keeping state in memory: %s", self.path, e)
+            self.write_failed = True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await asyncio.to_thread(self.flush)
+
+state = StateStore(state_file, state_flush_seconds)
+sample_state = StateStore(sample_state_file, sample_state_flush_seconds)
+
+# Fields extracted from the cloud responses, per response type.
+# The paths are compiled once at startup into direct accessors (see compile_path),
+# new fields only have to be added here.
+FIELDS = {
+    "stations": {
+        "status": "$.status",
+        "list": "$.data.list",
+        "total": "$.data.total",
+        "devices": "$..devices[*]"
+    },
+    "flow": {
+        "status": "$.status",
+        "dly": "$.data.dly",
+        "soc": "$.data.soc",
+        "flow": "$.data.flow"
+    },
+    "station": {
+        "status": "$.status",
+        "data_time": "$.data.data_time",
+        "start_date": "$.data.reflux_station_data.start_date",
+        "charge": "$.data.reflux_station_data.bms_in_eq",
+        "discharge": "$.data.reflux_station_data.bms_out_eq"
+    },
+    "inverter": {
+        "status": "$.status"
+    }
+}
+
+def collect_key(node, key, results):
+    """ Appends the items of every list stored under key, at any depth of node. """
+    if isinstance(node, dict):
+        for name, value in node.items():
+            if name == key and isinstance(value, list):
+                results.extend(value)
+            collect_key(value, key, results)
+    elif isinstance(node, list):
+        for value in node:
+            collect_key(value, key, results)
+
+def compile_path(path):
+    """
+    Compiles the JSONPath subset used in FIELDS into an accessor function.
+    Supported: "$", "$.a.b", "$.a[0].b" (returns the value or None)
+    and "$..a[*]" (returns a list of all items of every list "a" at any depth).
+    """
+    if path.startswith("$.."):
+        key = path[3:]
+        if key.endswith("[*]"):
+            key = key[:-3]
+
+        def find_all(document):
+            results = []
+            collect_key(document, key, results)
+            return results
+        return find_all
+
+    if path != "$" and not path.startswith("$."):
+        raise ValueError(f"Unsupported path: {path}")
+    steps = []
+    for part in path[2:].split(".") if path != "$" else []:
+        name, _, rest = part.partition("[")
+        if name:
+            steps.append(name)
+        while rest:
+            index, _, rest = rest.partition("]")
+            steps.append(int(index))
+            rest = rest.lstrip("[")
+    steps = tuple(steps)
+
+    def get(document):
+        value = document
+        for step in steps:
+            try:
+                value = value[step]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return value
+    return get
+
+def compile_fields(fields):
+    return {
+        response_type: {name: compile_path(path) for name, path in paths.items()}
+        for response_type, paths in fields.items()
+    }
+
+compiled_fields = compile_fields(FIELDS)
+
+def extract_fields(response_type, document):
+    """ Returns all FIELDS of a response type as dict, missing fields are None. """
+    return {name: accessor(document) for name, accessor in compiled_fields[response_type].items()}
+
+# Home Assistant sensors: every entry is read from the response of its feed (flow, station
+# or inverter), published depending on payload_mode and announced by publish_discovery.
+#   path:      field of the response, None if the value is computed in get_flow_data
+#   own_topic: always published to mqtt_topic/<sensor id>, also in raw and json mode
+# inverter sensors exist once per MS-A2 device of a station.
+SENSORS = {
+    "soc":                {"feed": "flow", "path": "$.data.soc", "own_topic": True,
+                           "name": "Battery State of Charge", "device_class": "battery", "state_class": "MEASUREMENT", "unit_of_measurement": "%"},
+    "power-battery":      {"feed": "flow", "path": None, "own_topic": True,
+                           "name": "Battery Power", "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"},
+    "power-to-battery":   {"feed": "flow", "path": None, "own_topic": True,
+                           "name": "Power to Battery", "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"},
+    "power-from-battery": {"feed": "flow", "path": None, "own_topic": True,
+                           "name": "Power from Battery", "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"},
+    "power-pv":           {"feed": "flow", "path": "$.data.power.pv",
+                           "name": "PV Power", "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"},
+    "power-grid":         {"feed": "flow", "path": "$.data.power.grid",
+                           "name": "Grid Power", "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"},
+    "power-load":         {"feed": "flow", "path": "$.data.power.load",
+                           "name": "Load Power", "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"},
+    "charge-today-live":  {"feed": "flow", "path": None, "own_topic": True,
+                           "name": "Charge Today (live)", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "discharge-today-live": {"feed": "flow", "path": None, "own_topic": True,
+                           "name": "Discharge Today (live)", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "charge-today":       {"feed": "station", "path": "$.data.reflux_station_data.bms_in_eq",
+                           "name": "Charge Today", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "discharge-today":    {"feed": "station", "path": "$.data.reflux_station_data.bms_out_eq",
+                           "name": "Discharge Today", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "grid-import-today":  {"feed": "station", "path": "$.data.reflux_station_data.meter_b_in_eq",
+                           "name": "Grid Import Today", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "grid-export-today":  {"feed": "station", "path": "$.data.reflux_station_data.meter_b_out_eq",
+                           "name": "Grid Export Today", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "pv-to-load-today":   {"feed": "station", "path": "$.data.reflux_station_data.pv_to_load_eq",
+                           "name": "PV to Load Today", "device_class": "energy", "state_class": "TOTAL_INCREASING", "unit_of_measurement": "Wh"},
+    "bms-temperature":    {"feed": "inverter", "path": "$.data.real_data.bms_temp",
+                           "name": "BMS Temperature", "device_class": "temperature", "state_class": "MEASUREMENT", "unit_of_measurement": "°C"},
+    "bms-soc":            {"feed": "inverter", "path": "$.data.real_data.bms_soc",
+                           "name": "BMS State of Charge", "device_class": "battery", "state_class": "MEASUREMENT", "unit_of_measurement": "%"},
+    "bms-state":          {"feed": "inverter", "path": "$.data.real_data.bms_state",
+                           "name": "BMS State"}
+}
+
+def compile_sensors(sensors):
+    """ Compiles the paths of SENSORS, per feed. """
+    compiled = {}
+    for sensor_id, sensor in sensors.items():
+        if sensor["path"]:
+            compiled.setdefault(sensor["feed"], {})[sensor_id] = compile_path(sensor["path"])
+    return compiled
+
+# Nodes of the flow graph: every entry of $.data.flow is a power v (W) from node o to node i
+FLOW_NODES = {
+    1:  ("load", "Load"),
+    2:  ("grid", "Grid"),
+    10: ("battery", "Battery"),
+    20: ("inverter", "Inverter"),
+    40: ("home", "AC Bus")
+}
+# Known power paths (o, i), e.g. (40, 20) charges the battery through the MS-A2, (20, 40) discharges it
+FLOW_PATHS = [(2, 40), (40, 2), (40, 1), (40, 20), (20, 40), (20, 10), (10, 20)]
+
+def flow_sensors():
+    """ SENSORS of the flow paths (power-grid-to-home, ...) and of the net power per node (power-net-grid, ...). """
+    sensors = {}
+    for source, sink in FLOW_PATHS:
+        sensors[f"power-{FLOW_NODES[source][0]}-to-{FLOW_NODES[sink][0]}"] = {
+            "feed": "flow", "path": None, "own_topic": True, "name": f"{FLOW_NODES[source][1]} to {FLOW_NODES[sink][1]} Power",
+            "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"}
+    for node_id, label in FLOW_NODES.values():
+        sensors[f"power-net-{node_id}"] = {
+            "feed": "flow", "path": None, "own_topic": True, "name": f"{label} Net Power",
+            "device_class": "power", "state_class": "MEASUREMENT", "unit_of_measurement": "W"}
+    return sensors
+
+SENSORS.update(flow_sensors())
+
+compiled_sensors = compile_sensors(SENSORS)
+
+# Decoder tables: (o, i) -> index of the path, node -> index of its net power
+FLOW_PATH_IDS = [f"power-{FLOW_NODES[source][0]}-to-{FLOW_NODES[sink][0]}" for source, sink in FLOW_PATHS]
+FLOW_PATH_INDEX = {path: index for index, path in enumerate(FLOW_PATHS)}
+FLOW_NET_IDS = [f"power-net-{node_id}" for node_id, _ in FLOW_NODES.values()]
+FLOW_NODE_INDEX = {node: index for index, node in enumerate(FLOW_NODES)}
+unknown_flow_paths = set()
+
+def decode_flow(flow, values):
+    """
+    Decodes the flow array in one pass into values: the power of every known path and the
+    net power (inflow - outflow) of every node, e.g. power-net-battery > 0 while charging.
+    Paths of unknown node pairs count for the net power of known nodes and are logged once.
+    """
+    paths = [0.0] * len(FLOW_PATHS)
+    nets = [0.0] * len(FLOW_NODES)
+    for edge in flow:
+        try:
+            source, sink, power = edge["o"], edge["i"], float(edge["v"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        index = FLOW_PATH_INDEX.get((source, sink))
+        if index is not None:
+            paths[index] += power
+        elif (source, sink) not in unknown_flow_paths:
+            unknown_flow_paths.add((source, sink))
+            log_flow.info("Unknown flow path %s -> %s (%s W).", source, sink, power)
+        index = FLOW_NODE_INDEX.get(source)
+        if index is not None:
+            nets[index] -= power
+        index = FLOW_NODE_INDEX.get(sink)
+        if index is not None:
+            nets[index] += power
+    for sensor_id, power in zip(FLOW_PATH_IDS, paths):
+        values[sensor_id] = round(power, 1)
+    for sensor_id, power in zip(FLOW_NET_IDS, nets):
+        values[sensor_id] = round(power, 1)
+    return values
+
+def extract_sensors(feed, document):
+    """ Returns the values of the SENSORS of a feed, sensor id -> value (missing values are left out). """
+    values = {}
+    for sensor_id, accessor in compiled_sensors.get(feed, {}).items():
+        value = accessor(document)
+        if value is not None:
+            values[sensor_id] = value
+    return values
+
+
+def new_station(station_sid, inverter_ids):
+    """ Returns the runtime state of one station (sid, MS-A2 device ids, burst uri and topics). """
+    return {
+        "sid": station_sid,
+        "inverter_ids": list(inverter_ids),
+        "topic": mqtt_topic,
+        "device_id": "hoymiles-ms-a2",
+        "dly": None
+    }
+
+def assign_station_topics(stations):
+    """
+    A single station keeps the plain mqtt_topic and device id, so existing setups do not change.
+    With several stations every station gets its own sub topic and Home Assistant device.
+    """
+    for station in stations:
+        if len(stations) == 1:
+            station["topic"] = mqtt_topic
+            station["device_id"] = "hoymiles-ms-a2"
+        else:
+            station["topic"] = f"{mqtt_topic}/{station['sid']}"
+            station["device_id"] = f"hoymiles-ms-a2-{station['sid']}"
+
+def inverter_topic(station, inverter_id):
+    if len(station["inverter_ids"]) > 1:
+        return f"{station['topic']}/inverter/{inverter_id}"
+    return f"{station['topic']}/inverter"
+
+def normalize_id(value):
+    """ The cloud uses numeric ids, ids read from text (config, json keys) are converted back. """
+    return int(value) if isinstance(value, str) and value.isdigit() else value
+
+def save_stations(stations):
+    state.set("stations", [{"sid": station["sid"], "inverter_ids": station["inverter_ids"]} for station in stations])
+
+def load_stations():
+    stations = []
+    try:
+        saved = state.get("stations")
+        if saved is None:
+            saved = json.loads(get_config_var("stations", "[]"))
+        for entry in saved:
+            stations.append(new_station(entry["sid"], entry.get("inverter_ids", [])))
+    except (ValueError, KeyError, TypeError) as e:
+        log.warning("Invalid saved stations, discovering stations again: %s", e)
+        stations = []
+    # older versions saved a single sid and inverterId in the config
+    legacy_sid = get_config_var("sid", None)
+    if not stations and legacy_sid:
+        legacy_inverter_id = get_config_var("inverterId", None)
+        stations.append(new_station(normalize_id(legacy_sid), [normalize_id(legacy_inverter_id)] if legacy_inverter_id else []))
+        save_stations(stations)
+    assign_station_topics(stations)
+    return stations
+
+stations = load_stations()
+poll_semaphore = None  # created in poll_loop, bounds the concurrent fetches
+background_tasks = set()  # strong references, asyncio only keeps weak ones to running tasks
+
+mqtt_client = None  # created in main, the backfill does not need one
+
+def create_mqtt_client():
+    global mqtt
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(mqtt_user, mqtt_password)
+    client.enable_logger(log_mqtt)
+    client.reconnect_delay_set(1, mqtt_reconnect_max_seconds)
+    client.max_queued_messages_set(mqtt_max_queued)  # QoS 1/2 messages kept by paho while disconnected
+    client.will_set(availability_topic, "offline", 1, True)
+    client.on_connect = on_mqtt_connect
+    client.on_disconnect = on_mqtt_disconnect
+    client.on_publish = on_mqtt_publish
+    client.on_message = on_mqtt_message
+    return client
+
+def create_http_session():
+    """
+    Creates the shared HTTP session used for all Hoymiles cloud calls.
+    Connections are pooled and kept alive per host, so a poll does not pay
+    a new TCP and TLS handshake for every request.
+    """
+    global requests
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(
+        total=http_retries,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    """ Returns the shared HTTP session, created on first use. """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = create_http_session()
+        return http_session
+
+def warm_up_host(url):
+    """ Opens a pooled connection (TCP and TLS handshake) to the host of url before the first request needs it. """
+    parts = urlsplit(url)
+    try:
+        get_http_session().head(f"{parts.scheme}://{parts.netloc}/", timeout=http_timeout_seconds)
+    except requests.RequestException as e:
+        log_http.debug("Warm-up of %s failed: %s", parts.netloc, e)
+
+async def warm_up():
+    """ Imports requests and connects to the cloud hosts the first polls need, all hosts in parallel. """
+    await asyncio.to_thread(get_http_session)
+    urls = {hoymiles_api_url, hoymiles_data_url}
+    urls.update(uri for uri in (credentials.get_uri(station["sid"]) for station in stations) if uri)
+    if not credentials.get_token():
+        urls.add(hoymiles_region_url)
+    hosts = {urlsplit(url).netloc: url for url in urls}
+    await asyncio.gather(*(asyncio.to_thread(warm_up_host, url) for url in hosts.values()))
+    mark_startup("http_ready")
+
+# Type and help text of the metrics (see Metrics)
+METRIC_INFO = {
+    "hoymiles_requests_total": ("counter", "Cloud requests per endpoint."),
+    "hoymiles_request_errors_total": ("counter", "Failed cloud requests (connection error or HTTP status other than 200) per endpoint."),
+    "hoymiles_request_duration_seconds": ("histogram", "Round-trip time of the cloud requests per endpoint."),
+    "hoymiles_token_refreshes_total": ("counter", "Successful logins."),
+    "hoymiles_token_refresh_failures_total": ("counter", "Failed logins."),
+    "hoymiles_shared_token_total": ("counter", "Token renewals through the shared token cache by result (login, reused)."),
+    "hoymiles_auth_wait_seconds_total": ("counter", "Seconds auth requests waited for the rate limiter."),
+    "hoymiles_uri_refreshes_total": ("counter", "Burst uri renewals per station."),
+    "hoymiles_uri_refresh_failures_total": ("counter", "Failed burst uri renewals per station."),
+    "hoymiles_dly_hits_total": ("counter", "Flow responses with dly 10000 (burst uri expired) per station."),
+    "hoymiles_feed_failures_total": ("counter", "Failed fetches per feed."),
+    "hoymiles_poll_lag_seconds": ("histogram", "Delay of the poll start behind its schedule per feed."),
+    "hoymiles_last_success_age_seconds": ("gauge", "Seconds since the last successful fetch per feed."),
+    "hoymiles_mqtt_publish_queue_depth": ("gauge", "MQTT messages handed to the client but not yet sent."),
+    "hoymiles_mqtt_messages_total": ("counter", "MQTT messages by result (sent, suppressed, buffered, deferred, failed)."),
+    "hoymiles_mqtt_publisher_queue_depth": ("gauge", "MQTT messages waiting in the publish queue of the bridge."),
+    "hoymiles_mqtt_connected": ("gauge", "1 while connected to the broker."),
+    "hoymiles_mqtt_connects_total": ("counter", "Successful connects to the broker (first connect and reconnects)."),
+    "hoymiles_mqtt_disconnects_total": ("counter", "Lost connections to the broker."),
+    "hoymiles_buffer_samples": ("gauge", "Samples in the on-disk buffer waiting for replay."),
+    "hoymiles_buffer_samples_total": ("counter", "Buffered samples by result (buffered, replayed, evicted)."),
+    "hoymiles_discovery_messages_total": ("counter", "Home Assistant discovery messages by result (published, unchanged)."),
+    "hoymiles_commands_total": ("counter", "MQTT commands per setting by result (received, coalesced, invalid, sent, failed, confirmed, unconfirmed)."),
+    "hoymiles_feed_fresh": ("gauge", "1 while the last good sample of a feed is younger than stale_after_intervals intervals."),
+    "hoymiles_response_cache_total": ("counter", "Cached endpoint requests by result (hit, miss, unchanged, not_modified)."),
+    "hoymiles_response_cache_entries": ("gauge", "Responses in the response cache."),
+    "hoymiles_sink_records_total": ("counter", "Sample records per sink by result (written, failed, dropped)."),
+    "hoymiles_sink_queue_depth": ("gauge", "Sample records waiting in the queue of a sink."),
+    "hoymiles_startup_seconds": ("gauge", "Seconds from the start of the bridge to a startup stage (mqtt_connected, http_ready, first_sample).")
+}
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms of the poll loop, rendered in the
+    Prometheus text format (/metrics on metrics_port) and as a json summary (MQTT stats topic).
+    Values that are only known on request (e.g. ages) are added by collector functions.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def add_collector(self, collector):
+        """ collector() returns a list of (name, labels, value) gauges. """
+        self.collectors.append(collector)
+
+    def gauges(self):
+        result = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    result[self.key(name, labels)] = value
+            except Exception as e:
+                log.warning("Metrics collector failed: %s", e)
+        return result
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text format. """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                          for key, value in self.histograms.items()}
+        samples = {}
+        for (name, labels), value in list(counters.items()) + list(self.gauges().items()):
+            samples.setdefault(name, []).append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = METRIC_INFO.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+    def summary(self):
+        """ Returns a compact json-friendly summary for the MQTT stats topic. """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (value["sum"], value["count"]) for key, value in self.histograms.items()}
+        result = {}
+        for (name, labels), value in list(counters.items()) + list(self.gauges().items()):
+            label = " ".join(str(value) for _, value in labels)
+            result.setdefault(name, {})[label or "total"] = value
+        for (name, labels), (total, count) in histograms.items():
+            label = " ".join(str(value) for _, value in labels)
+            result.setdefault(f"{name}_avg", {})[label or "total"] = round(total / count, 3) if count else 0
+        return result
+
+metrics = Metrics()
+
+startup_times = {}
+startup_lock = threading.Lock()
+
+def mark_startup(stage):
+    """ Records the seconds from the start to stage when it is reached the first time, returns True then. """
+    with startup_lock:
+        if stage in startup_times:
+            return False
+        startup_times[stage] = round(time.monotonic() - startup_started, 3)
+    log.info("Startup: %s after %.2f seconds.", stage.replace("_", " "), startup_times[stage])
+    return True
+
+def collect_startup_metrics():
+    with startup_lock:
+        return [("hoymiles_startup_seconds", {"stage": stage}, seconds) for stage, seconds in startup_times.items()]
+
+metrics.add_collector(collect_startup_metrics)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_metrics_server():
+    """ Serves /metrics on metrics_port in a background thread. """
+    try:
+        server = ThreadingHTTPServer((metrics_bind, metrics_port), MetricsHandler)
+    except OSError as e:
+        log.error("Could not start metrics server on port %s: %s", metrics_port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Metrics available on http://%s:%s/metrics", metrics_bind, metrics_port)
+    return server
+
+class TokenBucket:
+    """ Allows rate_per_minute calls with bursts of burst calls, acquire blocks until a call is allowed. """
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns the seconds waited. """
+        if self.rate <= 0:
+            return 0
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            # jitter, so processes started together do not retry in lockstep
+            wait += random.uniform(0, wait / 2)
+            time.sleep(wait)
+            waited += wait
+
+# every request to these endpoints passes the auth limiter, the burst uris (one per station) do not
+AUTH_ENDPOINTS = ("region_c", "login_c")
+auth_limiter = TokenBucket(auth_rate_per_minute, auth_burst)
+
+# responses kept by --record, the auth requests (password, token) are left out
+CAPTURE_ENDPOINTS = ("select_by_page_c", "flow", "real_g_c", "find_c")
+
+# status of the answers to an invalid or expired token
+TOKEN_ERROR_STATUSES = ("100",)
+
+def check_token_error(document):
+    """
+    Reports an answer to an invalid or expired token, the token is renewed right away
+    instead of after token_refresh_seconds. Returns True for such an answer.
+    """
+    if not isinstance(document, dict):
+        return False
+    message = str(document.get("message") or "").lower()
+    if str(document.get("status")) not in TOKEN_ERROR_STATUSES and "token" not in message and "login" not in message:
+        return False
+    log_auth.warning("Token rejected (%s), requesting a new one.", document.get("message"))
+    credentials.report_token_failure()
+    return True
 
 
-def save_login_url_to_config(login_url):
-    config["login_url"] = login_url
-    save_config(config_file, config)
+class CaptureWriter:
+    """
+    Appends the raw cloud responses to a gzip compressed capture file, one json line per response:
+    {"ts": unix time, "endpoint": "flow", "request": json body, "status": HTTP status, "body": response text}.
+    Urls and headers (token, burst uri) are not written. The file is flushed at most every
+    flush_seconds, a capture cut off by a crash is readable up to the last flush.
+    """
+
+    def __init__(self, path, flush_seconds=10):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.last_flush = time.monotonic()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, endpoint, payload, response):
+        line = json.dumps({"ts": round(time.time(), 3), "endpoint": endpoint, "request": payload,
+                           "status": response.status_code, "body": response.text}, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.count += 1
+            if time.monotonic() - self.last_flush >= self.flush_seconds:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        log_http.info("%s response(s) recorded to %s.", self.count, self.path)
+
+capture = None  # CaptureWriter of --record
+
+def http_post(endpoint, url, payload, headers=None, timeout=None):
+    """
+    Sends a POST request through the shared session and records the round-trip time.
+    :param endpoint: short endpoint name used for the statistics (e.g. "region_c")
+    :param url: request url
+    :param payload: json body
+    :param headers: additional request headers
+    :param timeout: timeout in seconds, defaults to http_timeout_seconds
+    """
+    session = get_http_session()
+    labels = {"endpoint": endpoint}
+    if endpoint in AUTH_ENDPOINTS:
+        waited = auth_limiter.acquire()
+        if waited:
+            log_auth.info("Auth requests rate limited, waited %.1f seconds.", waited)
+            metrics.inc("hoymiles_auth_wait_seconds_total", None, waited)
+    metrics.inc("hoymiles_requests_total", labels)
+    start = time.monotonic()
+    try:
+        response = session.post(url, json=payload, headers=headers, timeout=timeout or http_timeout_seconds)
+    except requests.RequestException:
+        metrics.observe("hoymiles_request_duration_seconds", labels, time.monotonic() - start)
+        metrics.inc("hoymiles_request_errors_total", labels)
+        raise
+    rtt = time.monotonic() - start
+    metrics.observe("hoymiles_request_duration_seconds", labels, rtt)
+    if response.status_code != 200:
+        metrics.inc("hoymiles_request_errors_total", labels)
+        if response.status_code == 401 and endpoint not in AUTH_ENDPOINTS:
+            credentials.report_token_failure()
+    log_http.debug("%s took %.0f ms", endpoint, rtt * 1000)
+    if capture is not None and endpoint in CAPTURE_ENDPOINTS:
+        capture.write(endpoint, payload, response)
+    return response
+
+
+class ResponseCache:
+    """
+    LRU cache of decoded cloud responses, keyed by endpoint and request body. A response
+    younger than the time to live of its endpoint is used without a request. An expired one
+    is requested again (conditionally, with If-None-Match, if the cloud sent an ETag) and a
+    response with the same hash is not decoded again but reported as unchanged.
+    """
+
+    def __init__(self, ttls, max_entries):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(endpoint, url, payload):
+        return (endpoint, url, json.dumps(payload, sort_keys=True))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, document, digest, etag):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = {"document": document, "digest": digest, "etag": etag,
+                                 "expires": time.monotonic() + self.ttls.get(key[0], 0)}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-def save_token_to_config(token):
-    config["token"] = token
-    save_config(config_file, config)
+    def renew(self, key):
+        """ The cloud confirmed the cached response, it is used for another time to live. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["expires"] = time.monotonic() + self.ttls.get(key[0], 0)
 
-def save_sid_to_config(sid):
-    config["sid"] = sid
-    save_config(config_file, config)
+    def size(self):
+        with self.lock:
+            return len(self.entries)
 
-def save_inverterId_to_config(sid):
-    config["inverterId"] = inverterId
-    save_config(config_file, config)
+response_cache = ResponseCache(response_cache_ttls, response_cache_size)
 
-# def save_uri_to_config(uri):
-#     config["uri"] = uri
-#     save_config(config_file, config)
+metrics.add_collector(lambda: [("hoymiles_response_cache_entries", None, response_cache.size())])
+
+def post_json(endpoint, url, payload, headers):
+    """
+    Sends a request through the response cache.
+    :return: (decoded response, False if it is the same as the last one of the request)
+    :raises requests.RequestException: connection errors and HTTP error status
+    :raises ValueError: invalid json
+    """
+    key = response_cache.key(endpoint, url, payload)
+    entry = response_cache.get(key)
+    labels = {"endpoint": endpoint}
+    if entry is not None and entry["expires"] > time.monotonic():
+        metrics.inc("hoymiles_response_cache_total", {**labels, "result": "hit"})
+        return entry["document"], False
+    if entry is not None and entry["etag"]:
+        headers = {**headers, "If-None-Match": entry["etag"]}
+    response = http_post(endpoint, url, payload, headers)
+    if response.status_code == 304 and entry is not None:
+        response_cache.renew(key)
+        metrics.inc("hoymiles_response_cache_total", {**labels, "result": "not_modified"})
+        return entry["document"], False
+    response.raise_for_status()
+    digest = hashlib.sha1(response.content).hexdigest()
+    if entry is not None and entry["digest"] == digest:
+        response_cache.renew(key)
+        metrics.inc("hoymiles_response_cache_total", {**labels, "result": "unchanged"})
+        return entry["document"], False
+    document = json.loads(response.text)
+    metrics.inc("hoymiles_response_cache_total", {**labels, "result": "miss"})
+    # errors (e.g. an invalid token) are not cached
+    if isinstance(document, dict) and str(document.get("status")) == "0":
+        response_cache.put(key, document, digest, response.headers.get("ETag"))
+    return document, True
+
+
+class PublishCache:
+    """
+    Remembers the last published value per topic. A value is only published again
+    if it changed by more than the deadband of the topic, or if the last publish
+    is older than the heartbeat.
+    """
+
+    def __init__(self, deadbands, heartbeat_seconds):
+        self.deadbands = deadbands
+        self.heartbeat_seconds = heartbeat_seconds
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def should_publish(self, topic, payload):
+        now = time.monotonic()
+        with self.lock:
+            last = self.last.get(topic)
+            if last is not None and now - last[1] < self.heartbeat_seconds:
+                last_payload = last[0]
+                if last_payload == payload:
+                    return False
+                deadband = self.deadbands.get(topic.rsplit("/", 1)[-1])
+                if (deadband and isinstance(payload, (int, float)) and isinstance(last_payload, (int, float))
+                        and abs(payload - last_payload) <= deadband):
+                    return False
+            self.last[topic] = (payload, now)
+            return True
+
+    def forget(self, topic):
+        """ Called if the publish failed, the next value of the topic is published in any case. """
+        with self.lock:
+            self.last.pop(topic, None)
+
+    def clear(self):
+        with self.lock:
+            self.last.clear()
+
+publish_cache = PublishCache(publish_deadbands, publish_heartbeat_seconds) if publish_on_change else None
+
+
+class SampleBuffer:
+    """
+    On-disk ring buffer (SQLite in WAL mode) of the samples that could not be published.
+    The payload bytes are tracked, above buffer_max_mb the oldest samples are evicted.
+    Once the broker is back the samples are replayed in order to mqtt_topic/replay/...
+    as {"ts": <unix time of the sample>, "payload": <original payload>}, so the live
+    topics are not overwritten with old values.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, topic TEXT, payload TEXT)")
+        self.count, self.size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(topic) + LENGTH(payload)), 0) FROM samples").fetchone()
+
+    def add(self, topic, payload):
+        payload = str(payload)
+        with self.lock:
+            self.db.execute("INSERT INTO samples (ts, topic, payload) VALUES (?, ?, ?)", (time.time(), topic, payload))
+            self.count += 1
+            self.size += len(topic) + len(payload)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # drop the oldest tenth (at least one sample) at once, not one row per insert
+        rows = self.db.execute("SELECT id, LENGTH(topic) + LENGTH(payload) FROM samples ORDER BY id LIMIT ?", (max(1, self.count // 10),)).fetchall()
+        if not rows:
+            return
+        self.db.execute("DELETE FROM samples WHERE id <= ?", (rows[-1][0],))
+        self.count -= len(rows)
+        self.size -= sum(row[1] for row in rows)
+        metrics.inc("hoymiles_buffer_samples_total", {"result": "evicted"}, len(rows))
+
+    def oldest(self, limit):
+        with self.lock:
+            return self.db.execute("SELECT id, ts, topic, payload FROM samples ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def remove(self, rows):
+        if not rows:
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (rows[-1][0],))
+            self.count -= len(rows)
+            self.size -= sum(len(row[2]) + len(row[3]) for row in rows)
+
+    def replay_once(self, limit):
+        """ Publishes up to limit samples, stops at the first one the client does not accept. """
+        sent = []
+        for row in self.oldest(limit):
+            _, ts, topic, payload = row
+            relative_topic = topic[len(mqtt_topic):] if topic.startswith(mqtt_topic + "/") else "/" + topic
+            info = mqtt_client.publish(f"{mqtt_topic}/replay{relative_topic}", json.dumps({"ts": ts, "payload": payload}))
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            sent.append(row)
+        self.remove(sent)
+        metrics.inc("hoymiles_buffer_samples_total", {"result": "replayed"}, len(sent))
+        return len(sent)
+
+    async def run(self):
+        if self.count:
+            log_mqtt.info("%s buffered sample(s) waiting for replay.", self.count)
+        while True:
+            await asyncio.sleep(1)
+            if self.count and mqtt_client.is_connected():
+                sent = await asyncio.to_thread(self.replay_once, max(1, buffer_replay_rate))
+                if sent and not self.count:
+                    log_mqtt.info("Buffered samples replayed.")
+
+def open_sample_buffer():
+    if buffer_max_mb <= 0:
+        return None
+    try:
+        return SampleBuffer(buffer_file, buffer_max_mb * 1024 * 1024)
+    except sqlite3.Error as e:
+        log_mqtt.warning("Could not open buffer file %s, samples are dropped while the broker is unreachable: %s", buffer_file, e)
+        return None
+
+sample_buffer = None  # opened in main, backfill and replay do not buffer
+
+# Messages handed to paho and not yet confirmed by on_publish
+mqtt_pending = {"count": 0}
+mqtt_pending_lock = threading.Lock()
+
+def on_mqtt_publish(client, userdata, mid, reason_code=None, properties=None):
+    with mqtt_pending_lock:
+        mqtt_pending["count"] = max(0, mqtt_pending["count"] - 1)
+
+def collect_publish_metrics():
+    samples = [("hoymiles_mqtt_publish_queue_depth", None, mqtt_pending["count"])]
+    if sample_buffer is not None:
+        samples.append(("hoymiles_buffer_samples", None, sample_buffer.count))
+    return samples
+
+metrics.add_collector(collect_publish_metrics)
+
+
+class Publisher:
+    """
+    Hands the MQTT messages to paho from one thread. publish_mqtt only appends to a
+    bounded queue and does not block the poll; the thread takes everything queued at
+    once, so the topics of one poll go out as one batch.
+    Messages paho does not accept (full queue, not connected) go to the sample buffer,
+    retained messages are remembered and published again after every (re)connect.
+    """
+
+    def __init__(self, max_queued):
+        self.max_queued = max_queued
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.retained = {}
+        self.deferred = set()  # retained topics not published yet
+        self.connects = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="mqtt-publisher", daemon=True)
+            self.thread.start()
+
+    def put(self, topic, payload, retain):
+        with self.condition:
+            if retain:
+                self.retained[topic] = payload
+            accepted = len(self.queue) < self.max_queued
+            if accepted:
+                self.queue.append((topic, payload, retain))
+                self.condition.notify()
+        if not accepted:
+            self.failed(topic, payload, retain, "publish queue full")
+
+    def remember(self, topic, payload):
+        """ Adds a retained message the broker already has, it is only published again after a reconnect. """
+        with self.condition:
+            self.retained[topic] = payload
+
+    def on_connect(self):
+        """ Publishes the retained messages again: after a reconnect all, after the first connect the deferred ones. """
+        with self.condition:
+            self.connects += 1
+            topics = set(self.retained) if self.connects > 1 else set(self.deferred)
+            messages = [(topic, payload) for topic, payload in self.retained.items() if topic in topics]
+            self.deferred.clear()
+        for topic, payload in messages:
+            self.put(topic, payload, True)
+
+    def depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def wait_empty(self, timeout):
+        deadline = time.monotonic() + timeout
+        while (self.depth() or mqtt_pending["count"]) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def failed(self, topic, payload, retain, reason):
+        if publish_cache is not None:
+            publish_cache.forget(topic)
+        if retain:
+            # published again after the (re)connect
+            with self.condition:
+                self.deferred.add(topic)
+            metrics.inc("hoymiles_mqtt_messages_total", {"result": "deferred"})
+            return
+        if sample_buffer is not None:
+            try:
+                sample_buffer.add(topic, payload)
+                metrics.inc("hoymiles_mqtt_messages_total", {"result": "buffered"})
+                metrics.inc("hoymiles_buffer_samples_total", {"result": "buffered"})
+                log_mqtt.warning("Could not publish, buffering samples: %s", reason)
+                return
+            except sqlite3.Error as e:
+                log_mqtt.error("Could not buffer sample: %s", e)
+        metrics.inc("hoymiles_mqtt_messages_total", {"result": "failed"})
+        log_mqtt.error("MQTT error: %s", reason)
+
+    def send(self, topic, payload, retain):
+        qos, topic_retain = mqtt_topic_options.get(topic.rsplit("/", 1)[-1], (mqtt_qos, False))
+        with mqtt_pending_lock:
+            mqtt_pending["count"] += 1
+        try:
+            rc = mqtt_client.publish(topic, payload, qos, retain or topic_retain).rc
+        except Exception as e:
+            rc, reason = None, str(e)
+        # QoS 1/2 messages are kept by paho while disconnected and sent after the reconnect
+        if rc == mqtt.MQTT_ERR_SUCCESS or (rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+            metrics.inc("hoymiles_mqtt_messages_total", {"result": "sent"})
+            # log_mqtt.debug("Published to %s: %s", topic, payload)
+            return
+        with mqtt_pending_lock:
+            mqtt_pending["count"] = max(0, mqtt_pending["count"] - 1)
+        self.failed(topic, payload, retain, reason if rc is None else mqtt.error_string(rc))
+
+    def drain(self):
+        """ Sends everything queued from the calling thread, returns the number of messages. """
+        with self.condition:
+            batch = list(self.queue)
+            self.queue.clear()
+        for topic, payload, retain in batch:
+            self.send(topic, payload, retain)
+        return len(batch)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+            self.drain()
+
+publisher = Publisher(mqtt_max_queued)
+
+
+def collect_connection_metrics():
+    return [("hoymiles_mqtt_publisher_queue_depth", None, publisher.depth()),
+            ("hoymiles_mqtt_connected", None, 1 if mqtt_client is not None and mqtt_client.is_connected() else 0)]
+
+metrics.add_collector(collect_connection_metrics)
+
+
+# time of the decoded sample, the replay sets it to the time of the captured response
+sample_clock = time.time
+
+def make_record(station, feed, values, device_id=None, timestamp=None):
+    """ Normalized record of one sample: numbers as float, other values as they are. """
+    normalized = {}
+    for sensor_id, value in values.items():
+        try:
+            normalized[sensor_id] = float(value)
+        except (TypeError, ValueError):
+            normalized[sensor_id] = value
+            continue
+        if not math.isfinite(normalized[sensor_id]):
+            normalized[sensor_id] = None
+    return {"ts": timestamp or sample_clock(), "sid": station["sid"], "feed": feed, "id": device_id, "values": normalized}
+
+def line_protocol(record):
+    """ InfluxDB line of a record: measurement hoymiles_<feed>, tags sid (and id), numeric fields, timestamp in ns. """
+    fields = ",".join(f"{sensor_id.replace('-', '_')}={value}" for sensor_id, value in record["values"].items()
+                      if isinstance(value, float))
+    if not fields:
+        return None
+    tags = f"sid={record['sid']}" + (f",id={record['id']}" if record["id"] is not None else "")
+    return f"hoymiles_{record['feed']},{tags} {fields} {int(record['ts'] * 1000000000)}"
+
+
+class Sink(abc.ABC):
+    """
+    Output of the sample records with its own thread and bounded queue. Records are written
+    in batches of up to batch_size, at the latest flush_seconds after the first one arrived.
+    A full queue drops the oldest records and a failed batch is written again after a pause,
+    so a slow or unreachable sink never blocks the poll or the other sinks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.batch_size = max(1, get_int_config_var(f"{name}_batch_size", 500))
+        self.flush_seconds = get_int_config_var(f"{name}_flush_seconds", 10)
+        self.queue = collections.deque(maxlen=max(1, get_int_config_var(f"{name}_queue_size", 10000)))
+        self.condition = threading.Condition()
+        self.failures = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name=f"sink-{name}", daemon=True)
+
+    def put(self, record):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                metrics.inc("hoymiles_sink_records_total", {"sink": self.name, "result": "dropped"})
+            self.queue.append(record)
+            if len(self.queue) == 1 or len(self.queue) >= self.batch_size:
+                self.condition.notify()
+
+    def depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    @abc.abstractmethod
+    def write(self, records):
+        """ Writes a batch, raises OSError (or requests.RequestException) if it failed. """
+
+    def close(self):
+        pass
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.queue:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.flush_seconds
+                while not self.stopping and len(self.queue) < self.batch_size and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                if self.stopping and not self.queue:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                self.write(batch)
+                self.failures = 0
+                metrics.inc("hoymiles_sink_records_total", {"sink": self.name, "result": "written"}, len(batch))
+            except Exception as e:
+                self.failures += 1
+                metrics.inc("hoymiles_sink_records_total", {"sink": self.name, "result": "failed"}, len(batch))
+                log.warning("Sink %s could not write %s record(s), retrying: %s", self.name, len(batch), e)
+                with self.condition:
+                    # back to the front, the oldest are dropped if the queue filled up meanwhile
+                    space = self.queue.maxlen - len(self.queue)
+                    self.queue.extendleft(reversed(batch[len(batch) - space:] if space < len(batch) else batch))
+                    if self.stopping:
+                        return
+                time.sleep(exponential_backoff(self.failures))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout):
+        """ Writes what is queued (within timeout) and ends the thread. """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        self.close()
+
+class InfluxHttpSink(Sink):
+    def __init__(self, url, token):
+        super().__init__("influx")
+        self.url = url
+        self.session = None  # its own, the shared one belongs to the cloud (and is a stand-in in the replay)
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if token:
+            self.headers["Authorization"] = f"Token {token}"
+
+    def write(self, records):
+        lines = [line for line in map(line_protocol, records) if line]
+        if lines:
+            if self.session is None:
+                self.session = create_http_session()
+            response = self.session.post(self.url, data="\n".join(lines).encode("utf-8"), headers=self.headers, timeout=http_timeout_seconds)
+            response.raise_for_status()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+class InfluxFileSink(Sink):
+    def __init__(self, path):
+        super().__init__("influx_file")
+        self.path = path
+
+    def write(self, records):
+        lines = [line for line in map(line_protocol, records) if line]
+        with open(self.path, "a") as file:
+            file.writelines(line + "\n" for line in lines)
+
+class NdjsonSink(Sink):
+    """ Appends the records as gzip compressed NDJSON, path is renamed to path.1 (path.1 to path.2, ...) at rotate_bytes. """
+
+    def __init__(self, path, rotate_bytes, keep):
+        super().__init__("ndjson")
+        self.path = path
+        self.rotate_bytes = rotate_bytes
+        self.keep = keep
+
+    def rotate(self):
+        for index in range(self.keep - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.keep > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, records):
+        # every batch is a gzip member of its own, the file stays readable if the bridge is killed
+        with gzip.open(self.path, "at", encoding="utf-8") as file:
+            file.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        if self.rotate_bytes > 0 and os.path.getsize(self.path) >= self.rotate_bytes:
+            self.rotate()
+
+class MqttRecordSink(Sink):
+    def __init__(self, topic):
+        super().__init__("records")
+        self.topic = topic
+
+    def write(self, records):
+        # handed to the publisher, which has its own queue and buffer
+        for record in records:
+            publish_mqtt(f"{self.topic}/{record['feed']}", json.dumps(record, separators=(",", ":")))
+
+def create_sinks():
+    sinks = []
+    if influx_url:
+        sinks.append(InfluxHttpSink(influx_url, influx_token))
+    if influx_file:
+        sinks.append(InfluxFileSink(influx_file))
+    if ndjson_file:
+        sinks.append(NdjsonSink(ndjson_file, ndjson_rotate_mb * 1024 * 1024, ndjson_keep))
+    if records_topic:
+        sinks.append(MqttRecordSink(records_topic))
+    return sinks
+
+sinks = create_sinks()
+
+def emit_record(station, feed, values, device_id=None):
+    """ Hands a decoded sample to every sink. """
+    if not sinks:
+        return
+    record = make_record(station, feed, values, device_id)
+    for sink in sinks:
+        sink.put(record)
+
+def collect_sink_metrics():
+    return [("hoymiles_sink_queue_depth", {"sink": sink.name}, sink.depth()) for sink in sinks]
+
+metrics.add_collector(collect_sink_metrics)
+
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties=None):
+    if reason_code.is_failure:
+        log_mqtt.warning("Connection to %s:%s refused: %s", mqtt_broker, mqtt_port, reason_code)
+        return
+    log_mqtt.info("Connected to %s:%s.", mqtt_broker, mqtt_port)
+    metrics.inc("hoymiles_mqtt_connects_total")
+    client.subscribe(f"{discovery_prefix}/status")
+    if enable_commands:
+        subscribe_commands(client)
+    # the broker may have lost retained messages and subscribers the last values
+    if publish_cache is not None:
+        publish_cache.clear()
+    publisher.on_connect()
+    if mark_startup("mqtt_connected"):
+        restore_last_values()
+
+def on_mqtt_disconnect(client, userdata, flags, reason_code, properties=None):
+    log_mqtt.warning("Disconnected from %s:%s (%s), reconnecting.", mqtt_broker, mqtt_port, reason_code)
+    metrics.inc("hoymiles_mqtt_disconnects_total")
 
-# Initialize MQTT client once
-mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-mqtt_client.username_pw_set(mqtt_user, mqtt_password)
-mqtt_client.connect(mqtt_broker, mqtt_port, 60)
-mqtt_client.loop_start()
 
 def publish_mqtt(topic, payload, publishAsRetain=False):
     """
-    Publishes data to the MQTT broker.
+    Publishes data to the MQTT broker (through the publish queue, see Publisher).
+    State values are only published on change (see PublishCache), retained messages always.
     :param topic: MQTT topic
     :param payload: Data to publish (dict or primitive type)
     """
-    try:
-        mqtt_client.publish(topic, payload, 0, publishAsRetain)
-        # debug_print(f"Published to {topic}: {payload}")
-    except Exception as e:
-        debug_print(f"MQTT error: {e}")
+    if not publishAsRetain and publish_cache is not None and not publish_cache.should_publish(topic, payload):
+        metrics.inc("hoymiles_mqtt_messages_total", {"result": "suppressed"})
+        return
+    publisher.put(topic, payload, publishAsRetain)
+
+
+def inverter_sensor_id(station, inverter_id, name):
+    if len(station["inverter_ids"]) > 1:
+        return f"{name}-{inverter_id}"
+    return name
+
+def projected_sensor(station, feed_topic, sensor_id, raw_template):
+    """ Returns state_topic and value_template of a sensor read from station or inverter data, depending on payload_mode. """
+    if payload_mode == "flat":
+        return {"state_topic": f"{station['topic']}/{sensor_id}"}
+    if payload_mode == "json":
+        return {"state_topic": feed_topic, "value_template": f"{{{{ value_json['{sensor_id}'] }}}}"}
+    return {"state_topic": feed_topic, "value_template": raw_template}
+
+def publish_feed(station, feed_topic, response, values):
+    """
+    Publishes the data of one response depending on payload_mode.
+    :param station: station the data belongs to
+    :param feed_topic: topic of the raw response, e.g. mqtt_topic/station
+    :param response: decoded cloud response
+    :param values: compact projection, sensor id -> value
+    """
+    if payload_mode == "raw":
+        messages = [(feed_topic, json.dumps(response))]
+    elif payload_mode == "flat":
+        messages = [(f"{station['topic']}/{sensor_id}", value) for sensor_id, value in values.items()]
+    else:
+        messages = [(feed_topic, json.dumps(values))]
+    publish_messages(feed_topic, messages)
+    if payload_mode != "raw" and publish_raw:
+        publish_mqtt(station["topic"] + "/debug" + feed_topic[len(station["topic"]):], json.dumps(response))
+
+
+last_messages = {}  # feed topic -> messages of its last sample since the start, saved values are not published again
+
+def publish_messages(feed_topic, messages):
+    """ Publishes the (topic, payload) messages of one sample of a feed and saves them as its last values. """
+    for topic, payload in messages:
+        publish_mqtt(topic, payload)
+    mark_startup("first_sample")
+    last_messages[feed_topic] = messages
+    if last_values_max_age_seconds <= 0:
+        return
+    last_values = dict(sample_state.get("last_values") or {})
+    last_values[feed_topic] = {"ts": round(time.time()), "mode": payload_mode, "messages": messages}
+    sample_state.set("last_values", last_values)
+
+def restore_last_values():
+    """ Publishes the values saved before the restart, subscribers get values before the first poll answered. """
+    if last_values_max_age_seconds <= 0:
+        return
+    now, restored = time.time(), 0
+    for feed_topic, saved in (sample_state.get("last_values") or {}).items():
+        if feed_topic in last_messages or saved.get("mode") != payload_mode or now - saved.get("ts", 0) > last_values_max_age_seconds:
+            continue
+        for topic, payload in saved.get("messages", []):
+            publish_mqtt(topic, payload)
+        restored += 1
+    if restored:
+        log_mqtt.info("Published the saved values of %s feed(s).", restored)
+
+def publish_unchanged(feed_topic):
+    """
+    Publishes the last sample of a feed again for an unchanged response, without decoding and
+    serializing it (the publish cache drops the messages until their heartbeat).
+    Returns False if the feed has no sample yet.
+    """
+    messages = last_messages.get(feed_topic)
+    if messages is None:
+        return False
+    for topic, payload in messages:
+        publish_mqtt(topic, payload)
+    return True
 
+def publish_startup(stations):
+    """ Publishes everything known without the cloud: availability and the discovery of the saved stations. """
+    publish_mqtt(availability_topic, "online", True)
+    for station in stations:
+        publish_discovery(station)
 
-def publish_discovery():
-    """ Publishes Home Assistant MQTT Discovery messages for all sensors. """
-    discovery_prefix = "homeassistant"
 
-    # Define the sensors and their topics
-    sensors = {
-        "power-to-battery": {
-            "name": "Power to Battery",
-            "device_class": "power",
-            "state_class": "MEASUREMENT",
-            "unit_of_measurement": "W",
-            "state_topic": f"{mqtt_topic}/power-to-battery"
-        },
-        "power-from-battery": {
-            "name": "Power from Battery",
-            "device_class": "power",
-            "state_class": "MEASUREMENT",
-            "unit_of_measurement": "W",
-            "state_topic": f"{mqtt_topic}/power-from-battery"
-        },
-        "bms-temperature": {
-            "name": "BMS Temperature",
-            "device_class": "temperature",
-            "state_class": "MEASUREMENT",
-            "unit_of_measurement": "°C",
-            "value_template":"{{ value_json.data.real_data.bms_temp }}",
-            "state_topic": f"{mqtt_topic}/inverter"
-        },
-        "charge-today": {
-            "name": "Charge Today",
-            "device_class": "energy",
-            "state_class": "TOTAL_INCREASING",
-            "unit_of_measurement": "Wh",
-            "value_template": "{{ value_json.data.reflux_station_data.bms_in_eq }}",
-            "state_topic": f"{mqtt_topic}/station"
-        },
-        "discharge-today": {
-            "name": "Discharge Today",
-            "device_class": "energy",
-            "state_class": "TOTAL_INCREASING",
-            "unit_of_measurement": "Wh",
-            "value_template": "{{ value_json.data.reflux_station_data.bms_out_eq }}",
-            "state_topic": f"{mqtt_topic}/station"
-        },
-        "soc": {
-            "name": "Battery State of Charge",
-            "device_class": "battery",
-            "state_class": "MEASUREMENT",
-            "unit_of_measurement": "%",
-            "state_topic": f"{mqtt_topic}/soc"
-        }
-    }
+class DiscoveryCache:
+    """
+    Serialized discovery messages per config topic. A message is only published if its hash
+    changed since it was published last (the hashes are kept in the state file, so a restart
+    does not publish hundreds of unchanged messages again). All messages are published again
+    when Home Assistant sends its birth message and after a reconnect (see Publisher).
+    """
+
+    def __init__(self):
+        self.payloads = {}
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        data = json.dumps(payload, sort_keys=True)
+        digest = hashlib.sha1(data.encode("utf-8")).hexdigest()
+        with self.lock:
+            self.payloads[topic] = data
+            hashes = state.get("discovery_hashes", {})
+            if hashes.get(topic) == digest:
+                publisher.remember(topic, data)
+                metrics.inc("hoymiles_discovery_messages_total", {"result": "unchanged"})
+                return
+            state.set("discovery_hashes", {**hashes, topic: digest})
+        publish_mqtt(topic, data, True)
+        metrics.inc("hoymiles_discovery_messages_total", {"result": "published"})
+
+    def republish(self):
+        with self.lock:
+            messages = list(self.payloads.items())
+        log_mqtt.info("Publishing %s discovery message(s) again.", len(messages))
+        for topic, data in messages:
+            publish_mqtt(topic, data, True)
+        metrics.inc("hoymiles_discovery_messages_total", {"result": "published"}, len(messages))
+
+discovery = DiscoveryCache()
+
+
+def raw_template(path):
+    """ Value template of a SENSORS path in the raw response, e.g. {{ value_json.data.soc }}. """
+    return "{{ value_json" + path[1:] + " }}"
+
+def publish_discovery(station):
+    """
+    Publishes the Home Assistant MQTT Discovery messages of a station, generated from SENSORS
+    (and the controls with enable_commands). Stations with several MS-A2 get one device per MS-A2.
+    """
+    topic = station["topic"]
+    device_id = station["device_id"]
+    several_inverters = len(station["inverter_ids"]) > 1
 
     # Device information
     device_info = {
-        "identifiers": ["hoymiles-ms-a2"],
+        "identifiers": [device_id],
         "manufacturer": "Hoymiles",
         "model": "MS-A2",
-        "name": "Hoymiles MS-A2",
+        "name": "Hoymiles MS-A2" if device_id == "hoymiles-ms-a2" else f"Hoymiles MS-A2 {station['sid']}",
         "sw_version": "1.0"
     }
 
-    for sensor_id, sensor in sensors.items():
-        discovery_topic = f"{discovery_prefix}/sensor/hoymiles-ms-a2/{sensor_id}/config"
+    # single station setups keep their original unique ids
+    unique_prefix = "hoymiles" if device_id == "hoymiles-ms-a2" else f"hoymiles_{station['sid']}"
+
+    # sensor id -> (sensor, name, state topic and value template, device, feed topic)
+    entities = {}
+    for sensor_id, sensor in SENSORS.items():
+        if sensor["feed"] == "inverter":
+            for inverter_id in station["inverter_ids"]:
+                entity_id = inverter_sensor_id(station, inverter_id, sensor_id)
+                device = device_info
+                if several_inverters:
+                    device = {**device_info, "identifiers": [f"{device_id}-{inverter_id}"],
+                              "name": f"{device_info['name']} {inverter_id}", "via_device": device_id}
+                entities[entity_id] = (
+                    sensor,
+                    f"{sensor['name']} {inverter_id}" if several_inverters else sensor["name"],
+                    projected_sensor(station, inverter_topic(station, inverter_id), entity_id, raw_template(sensor["path"])),
+                    device, inverter_topic(station, inverter_id))
+        elif sensor.get("own_topic"):
+            entities[sensor_id] = (sensor, sensor["name"], {"state_topic": f"{topic}/{sensor_id}"}, device_info, f"{topic}/{sensor['feed']}")
+        else:
+            entities[sensor_id] = (
+                sensor, sensor["name"],
+                projected_sensor(station, f"{topic}/{sensor['feed']}", sensor_id, raw_template(sensor["path"])),
+                device_info, f"{topic}/{sensor['feed']}")
+
+    for entity_id, (sensor, name, state_topic, device, feed_topic) in entities.items():
         payload = {
-            "name": sensor["name"],
-            "unique_id": f"hoymiles_{sensor_id}",
-            "state_topic": sensor["state_topic"],
-            "device": device_info
+            "name": name,
+            "unique_id": f"{unique_prefix}_{entity_id}",
+            "device": device,
+            # unavailable if the bridge is gone or the feed is stale, expired if no value arrives
+            "availability": [{"topic": availability_topic}, {"topic": f"{feed_topic}/availability"}],
+            "availability_mode": "all",
+            "expire_after": expire_after(sensor["feed"]),
+            **state_topic
+        }
+        for key in ("unit_of_measurement", "device_class", "state_class"):
+            if key in sensor:
+                payload[key] = sensor[key]
+
+        discovery.publish(f"{discovery_prefix}/sensor/{device_id}/{entity_id}/config", payload)
+
+    if not enable_commands:
+        return
+
+    controls = {
+        "grid-charge": {
+            "component": "switch",
+            "name": "Charge from Grid",
+            "payload_on": "ON",
+            "payload_off": "OFF"
+        },
+        "grid-power": {
+            "component": "number",
+            "name": "On-grid Input Power",
+            "device_class": "power",
+            "unit_of_measurement": "W",
+            "min": 0,
+            "max": grid_power_max,
+            "step": 1,
+            "mode": "box"
         }
+    }
 
-        if "unit_of_measurement" in sensor:
-            payload["unit_of_measurement"] = sensor["unit_of_measurement"]
-        if "device_class" in sensor:
-            payload["device_class"] = sensor["device_class"]
-        if "state_class" in sensor:
-            payload["state_class"] = sensor["state_class"]
-        if "value_template" in sensor:
-            payload["value_template"] = sensor["value_template"]
+    for setting_id, control in controls.items():
+        payload = {
+            "name": control["name"],
+            "unique_id": f"{unique_prefix}_{setting_id}",
+            "state_topic": f"{topic}/{setting_id}",
+            "command_topic": f"{topic}/set/{setting_id}",
+            "availability_topic": availability_topic,
+            "device": device_info
+        }
+        payload.update({key: value for key, value in control.items() if key not in ("component", "name")})
 
-        publish_mqtt(discovery_topic, json.dumps(payload), True)
+        discovery.publish(f"{discovery_prefix}/{control['component']}/{device_id}/{setting_id}/config", payload)
 
 
 
@@ -225,28 +1925,28 @@ def request_new_token():
 
         # get region for login
 
-        url_region = "https://euapi.hoymiles.com/iam/pub/0/c/region_c"
+        url_region = hoymiles_region_url + "/iam/pub/0/c/region_c"
         payload_region = { "email": hoymiles_user }
         headers = {'Content-Type': 'application/json; charset=utf-8'}
 
-        response_region = requests.post(url_region, json=payload_region, headers=headers)
+        response_region = http_post("region_c", url_region, payload_region, headers)
 
         if response_region.status_code == 200:
             try:
                 response_region_data = json.loads(response_region.text)
                 if response_region_data.get("status") == "0" and "data" in response_region_data:
-                    debug_print(f"Region Data Response: {response_region_data}")
+                    log_auth.debug("Region Data Response: %s", response_region_data)
                     login_url = response_region_data["data"].get("login_url")
                     if login_url:
-                        save_login_url_to_config(login_url)
+                        state.set("login_url", login_url)
                 else:
-                    debug_print(f"Error Message: {response_region_data.get('message')}")
+                    log_auth.error("Error Message: %s", response_region_data.get('message'))
                     token = None
             except ValueError as e:
-                debug_print(f"Error decoding JSON response: {e}")
+                log_auth.error("Error decoding JSON response: %s", e)
                 token = None
         else:
-            debug_print(f"Failed to get region. Status Code: {response_region.status_code}")
+            log_auth.error("Failed to get region. Status Code: %s", response_region.status_code)
             token = None
 
 
@@ -261,102 +1961,101 @@ def request_new_token():
         }
 
         # Send the POST request for login
-        response_login = requests.post(get_token_url, json=data_login, headers=headers)
+        response_login = http_post("login_c", get_token_url, data_login, headers)
 
         # Check the response
         if response_login.status_code == 200:
             try:
                 response_data = json.loads(response_login.text)
                 if response_data.get("status") == "0" and "data" in response_data:
-                    debug_print(f"Token Data Response: {response_data}")
+                    log_auth.debug("Token Data Response: %s", response_data)
                     token = response_data["data"].get("token")
-                    if token:
-                        save_token_to_config(token)
                 else:
-                    debug_print(f"Error Message: {response_data.get('message')}")
+                    log_auth.error("Error Message: %s", response_data.get('message'))
                     token = None
             except ValueError as e:
-                debug_print(f"Error decoding JSON response: {e}")
+                log_auth.error("Error decoding JSON response: %s", e)
                 token = None
         else:
-            debug_print(f"Failed to login. Status Code: {response_login.status_code}")
+            log_auth.error("Failed to login. Status Code: %s", response_login.status_code)
             token = None
 
     except requests.RequestException as e:
-        debug_print(f"Request failed: {e}")
+        log_auth.error("Request failed: %s", e)
         token = None
 
     except Exception as e:
-        debug_print(f"An unexpected error occurred: {e}")
+        log_auth.exception("An unexpected error occurred: %s", e)
         token = None
 
     return token
 
-def get_sid(localtoken):
+def get_stations(localtoken):
+    """
+    Discovers all stations of the account across all pages, with the ids of
+    their MS-A2 devices (type 6).
+    :return: list of station dicts or None if the discovery failed
+    """
     try:
-        # Use the token to send a request for the SID
-        url_station = "https://neapi.hoymiles.com/pvmc/api/0/station/select_by_page_c"
+        # Use the token to send a request for the station list
+        url_station = hoymiles_api_url + "/pvmc/api/0/station/select_by_page_c"
         headers_with_auth = {
             'Content-Type': 'application/json; charset=utf-8',
             'Authorization': localtoken
         }
-        data_station = {"page": 1, "page_size": 50}
-        response_station = requests.post(url_station, json=data_station, headers=headers_with_auth)
-
-        if response_station.status_code == 200:
+        page_size = 50
+        page = 1
+        found_stations = []
+        while True:
+            data_station = {"page": page, "page_size": page_size}
             try:
-                station_data = json.loads(response_station.text)
-                debug_print(f"Get Sid Response: {station_data}")
-
-                if station_data.get("status") == "0":
-                    # Use JSONPath to extract the 'sid'
-                    jsonpath_sid = parse('$.data.list[0].sid')
-                    match_sid = jsonpath_sid.find(station_data)
-
-                    jsonpath_devices = parse("$..devices[*]")
-                    devices = [match.value for match in jsonpath_devices.find(station_data)]
-                    
-                    global inverterId
-                    for device in devices:
-                        if device.get("type") == 6:
-                            inverterId = device.get("id")
-                            break
-                    
-                    if inverterId:
-                        debug_print(f"ID with type 6 retrieved: {inverterId}")
-                        save_inverterId_to_config(inverterId)
-                    else:
-                        debug_print("ID with type 6 not found in get sid response.")
-
-                    if match_sid:
-                        localsid = match_sid[0].value
-                        debug_print(f"SID retrieved: {localsid}")
-                        save_sid_to_config(localsid)
-                        return localsid
-                    else:
-                        debug_print("SID not found in get sid response.")
-                        return None
-                else:
-                    debug_print(f"Failed to retrieve sid data: {station_data.get('message')}")
-                    return None
+                station_data, _ = post_json("select_by_page_c", url_station, data_station, headers_with_auth)
             except ValueError as e:
-                debug_print(f"Error decoding JSON response: {e}")
+                log_station.error("Error decoding JSON response: %s", e)
                 return None
-        else:
-            debug_print(f"Failed to fetch sid data. Status Code: {response_station.status_code}")
+            log_station.debug("Get Sid Response (page %s): %s", page, station_data)
+
+            fields = extract_fields("stations", station_data)
+            if fields["status"] != "0":
+                check_token_error(station_data)
+                log_station.error("Failed to retrieve sid data: %s", station_data.get('message'))
+                return None
+
+            station_list = fields["list"] or []
+            devices_accessor = compiled_fields["stations"]["devices"]
+            for entry in station_list:
+                localsid = entry.get("sid")
+                if localsid is None:
+                    continue
+                devices = devices_accessor(entry)
+                inverter_ids = [device.get("id") for device in devices if isinstance(device, dict) and device.get("type") == 6]
+                log_station.info("SID retrieved: %s | IDs with type 6: %s", localsid, inverter_ids)
+                found_stations.append(new_station(localsid, inverter_ids))
+
+            total = fields["total"]
+            if len(station_list) < page_size or (total is not None and len(found_stations) >= int(total)):
+                break
+            page += 1
+
+        if not found_stations:
+            log_station.warning("SID not found in get sid response.")
             return None
 
+        assign_station_topics(found_stations)
+        save_stations(found_stations)
+        return found_stations
+
     except requests.RequestException as e:
-        debug_print(f"Request failed: {e}")
+        log_station.error("Request failed: %s", e)
         return None
     except Exception as e:
-        debug_print(f"An unexpected error occurred: {e}")
+        log_station.exception("An unexpected error occurred: %s", e)
         return None
 
 def get_uri(localtoken, localsid):
     try:
         # Step 5: Use the token and sid to get the uri
-        url_sd_uri = "https://neapi.hoymiles.com/pvmc/api/0/station/get_sd_uri_c"
+        url_sd_uri = hoymiles_api_url + "/pvmc/api/0/station/get_sd_uri_c"
         headers_with_auth = {
             'Content-Type': 'application/json; charset=utf-8',
             'Authorization': localtoken
@@ -364,270 +2063,1392 @@ def get_uri(localtoken, localsid):
 
         data_sd_uri = {"sid": localsid}
 
-        response_sd_uri = requests.post(url_sd_uri, json=data_sd_uri, headers=headers_with_auth)
+        response_sd_uri = http_post("get_sd_uri_c", url_sd_uri, data_sd_uri, headers_with_auth)
 
         if response_sd_uri.status_code == 200:
             try:
                 sd_uri_data = json.loads(response_sd_uri.text)
-                debug_print(f"SD URI Data Response: {sd_uri_data}")
+                log_auth.debug("SD URI Data Response: %s", sd_uri_data)
 
                 if sd_uri_data.get("status") == "0" and "data" in sd_uri_data:
                     localuri = sd_uri_data["data"].get("uri")
                     if localuri:
-                        debug_print(f"URI retrieved: {localuri}")
+                        log_auth.debug("URI retrieved: %s", localuri)
                         return localuri
                     else:
-                        debug_print("URI not found in sd_uri data response.")
+                        log_auth.warning("URI not found in sd_uri data response.")
                         return None
                 else:
-                    debug_print(f"Failed to retrieve sd_uri data: {sd_uri_data.get('message')}")
-                    global token
-                    token = None
-                    debug_print("requesting new token...")
+                    log_auth.warning("Failed to retrieve sd_uri data: %s", sd_uri_data.get('message'))
+                    credentials.report_token_failure()
+                    log_auth.info("requesting new token...")
                     return None
             except ValueError as e:
-                debug_print(f"Error decoding JSON response: {e}")
+                log_auth.error("Error decoding JSON response: %s", e)
                 return None
         else:
-            debug_print(f"Failed to fetch sd_uri. Status Code: {response_sd_uri.status_code}")
+            log_auth.error("Failed to fetch sd_uri. Status Code: %s", response_sd_uri.status_code)
             if response_sd_uri.status_code == 400:  # Bad Request, trigger re-request of URI
                 return None
             return None
 
     except requests.RequestException as e:
-        debug_print(f"Request failed: {e}")
+        log_auth.error("Request failed: %s", e)
         return None
 
     except Exception as e:
-        debug_print(f"An unexpected error occurred: {e}")
+        log_auth.exception("An unexpected error occurred: %s", e)
         return None
 
+def split_energy(start_power, end_power, seconds):
+    """
+    Returns (charge Wh, discharge Wh) of a power changing linearly from start_power to
+    end_power (W, positive = charging) over seconds, split where the power crosses zero.
+    """
+    if start_power >= 0 and end_power >= 0:
+        return (start_power + end_power) / 2 * seconds / 3600, 0.0
+    if start_power <= 0 and end_power <= 0:
+        return 0.0, -(start_power + end_power) / 2 * seconds / 3600
+    crossing = seconds * start_power / (start_power - end_power)
+    before = start_power / 2 * crossing / 3600
+    after = end_power / 2 * (seconds - crossing) / 3600
+    return (before, -after) if start_power > 0 else (after, -before)
+
+class EnergyIntegrator:
+    """
+    Charge and discharge energy of today per station, integrated from the battery power of
+    the flow samples. Intervals longer than energy_max_gap_seconds are not integrated, the
+    counters start at 0 at local midnight and are kept in sample_state_file.
+    The station data re-anchors the counters to the cloud totals (bms_in_eq, bms_out_eq) of
+    its data_time, plus what was integrated since then. The published counters never go down
+    within a day (Home Assistant would read that as a meter reset), a lower estimate is held
+    until the energy catches up.
+    """
+
+    def __init__(self):
+        self.entries = None
+        self.checkpoints = {}  # sid -> (times, integrated (charge, discharge)) of today, to anchor at data_time
+        self.lock = threading.Lock()
+
+    def entry(self, sid, day):
+        if self.entries is None:
+            self.entries = {normalize_id(key): value for key, value in (sample_state.get("energy") or {}).items()}
+        entry = self.entries.get(sid)
+        if entry is None or entry["day"] != day:
+            # the last sample of yesterday stays, the interval over midnight is split
+            entry = self.entries[sid] = {"day": day, "integrated": [0.0, 0.0], "offset": [0.0, 0.0], "published": [0.0, 0.0],
+                                         "last_time": entry and entry["last_time"], "last_power": entry and entry["last_power"]}
+            self.checkpoints[sid] = ([], [])
+        return entry
+
+    def add_sample(self, sid, timestamp, power):
+        """ Integrates a battery power sample (W, positive = charging), returns the live counters. """
+        day = station_day(timestamp).isoformat()
+        with self.lock:
+            entry = self.entry(sid, day)
+            last_time, last_power = entry["last_time"], entry["last_power"]
+            if last_time is not None and 0 < timestamp - last_time <= energy_max_gap_seconds:
+                midnight = station_time(day)
+                if last_time < midnight:
+                    # the counters were reset at midnight, only the rest of the interval belongs to today
+                    last_power += (power - last_power) * (midnight - last_time) / (timestamp - last_time)
+                    last_time = midnight
+                charge, discharge = split_energy(last_power, power, timestamp - last_time)
+                entry["integrated"][0] += charge
+                entry["integrated"][1] += discharge
+            entry["last_time"], entry["last_power"] = timestamp, power
+            times, totals = self.checkpoints.setdefault(sid, ([], []))
+            times.append(timestamp)
+            totals.append(tuple(entry["integrated"]))
+            if len(times) > 4096:
+                del times[:1024], totals[:1024]
+            return self.publish(entry)
+
+    def anchor(self, sid, day, cloud_charge, cloud_discharge, timestamp):
+        """ Sets today's counters to the cloud totals at timestamp plus the energy integrated since then. """
+        with self.lock:
+            entry = self.entry(sid, day)
+            times, totals = self.checkpoints.setdefault(sid, ([], []))
+            index = bisect.bisect_right(times, timestamp) - 1
+            # before the first sample of this run nothing is known to be integrated since then
+            integrated_then = totals[index] if index >= 0 else (totals[0] if totals else tuple(entry["integrated"]))
+            entry["offset"] = [cloud_charge - integrated_then[0], cloud_discharge - integrated_then[1]]
+            self.publish(entry)
+
+    def publish(self, entry):
+        for index in (0, 1):
+            entry["published"][index] = max(entry["published"][index], entry["integrated"][index] + entry["offset"][index])
+        sample_state.set("energy", {str(sid): {**value, "integrated": list(value["integrated"]), "offset": list(value["offset"]),
+                                               "published": list(value["published"])} for sid, value in self.entries.items()})
+        return {"charge-today-live": round(entry["published"][0], 1), "discharge-today-live": round(entry["published"][1], 1)}
+
+energy = EnergyIntegrator()
+
+
+def anchor_energy(station, response):
+    """ Re-anchors the live energy counters to the totals of today's station data. """
+    fields = extract_fields("station", response)
+    today = station_day(sample_clock()).isoformat()
+    if fields["start_date"] not in (None, today):
+        return
+    try:
+        cloud_charge, cloud_discharge = float(fields["charge"]), float(fields["discharge"])
+    except (TypeError, ValueError):
+        return
+    try:
+        timestamp = station_time(*fields["data_time"].split(" ", 1))
+    except (AttributeError, TypeError, ValueError):
+        timestamp = sample_clock()
+    if station_day(timestamp).isoformat() != today:
+        return
+    energy.anchor(station["sid"], today, cloud_charge, cloud_discharge, timestamp)
+
+
 # Function to handle the final request logic
-def get_flow_data(flowtoken, flowsid, flowuri):
+def get_flow_data(flowtoken, station):
     try:
-        final_data = {"m": 0, "sid": flowsid}
+        flowuri = credentials.get_uri(station["sid"])
+        final_data = {"m": 0, "sid": station["sid"]}
         headers = {'Authorization': flowtoken}
 
         try:
-            response_final = requests.post(flowuri, json=final_data, headers=headers, timeout=10)
+            response_final = http_post("flow", flowuri, final_data, headers)
             response_final.raise_for_status()  # Raise an error for 4xx/5xx responses
         except requests.exceptions.RequestException as e:
-            debug_print(f"Request failed: {e}")
-            return
+            log_flow.error("Request failed: %s", e)
+            return False
 
         try:
             final_data_response = json.loads(response_final.text)
         except (json.JSONDecodeError, ValueError) as e:
-            debug_print(f"JSON decoding error: {e}")
-            return
+            log_flow.error("JSON decoding error: %s", e)
+            return False
+
+        log_flow.debug("Final Data Response: %s", final_data_response)
+
+        fields = extract_fields("flow", final_data_response)
+        if fields["status"] != "0":
+            check_token_error(final_data_response)
+            log_flow.warning("Failed to retrieve final data: %s", final_data_response.get('message', 'Unknown error'))
+            return False
+
+        # dly is the server's hint in ms how long to wait before the next flow request
+        dly = fields["dly"]
+        if isinstance(dly, (int, float)):
+            station["dly"] = dly / 1000
+        if dly == 10000:
+            log_flow.info("Received response with dly: 10000, requesting a new URI.")
+            metrics.inc("hoymiles_dly_hits_total", {"sid": station["sid"]})
+            credentials.report_uri_failure(station["sid"])
+            return "retry"
+
+        soc = fields["soc"]
+        flow = fields["flow"]
+
+        if soc is None or not flow:
+            log_flow.warning("SOC or flow data not found.")
+            return False
+
+        values = decode_flow(flow, extract_sensors("flow", final_data_response))
+
+        # the battery is charged and discharged through the MS-A2, from and to the AC bus
+        power_to_battery = values["power-home-to-inverter"]
+        power_from_battery = values["power-inverter-to-home"]
+        power_battery = round(power_to_battery - power_from_battery, 1)
+        values.update({"power-to-battery": power_to_battery, "power-from-battery": power_from_battery, "power-battery": power_battery})
+        values.update(energy.add_sample(station["sid"], sample_clock(), power_battery))
+        emit_record(station, "flow", values)
+
+        # soc and battery power are always published as own topics, flat mode needs no extra flow topic
+        messages = [(f"{station['topic']}/{sensor_id}", value) for sensor_id, value in values.items()
+                    if SENSORS[sensor_id].get("own_topic") or payload_mode == "flat"]
+        mqtt_topic_flow = station["topic"] + "/flow"
+        if payload_mode == "raw":
+            messages.append((mqtt_topic_flow, json.dumps(final_data_response)))
+        elif payload_mode == "json":
+            messages.append((mqtt_topic_flow, json.dumps(values)))
+        publish_messages(mqtt_topic_flow, messages)
+        if payload_mode != "raw" and publish_raw:
+            publish_mqtt(station["topic"] + "/debug/flow", json.dumps(final_data_response))
+        log_flow.debug("SOC retrieved: %s  | power-battery: %s | power-to-battery: %s | power-from-battery: %s", soc, power_battery, power_to_battery, power_from_battery)
+        return True
 
-        debug_print(f"Final Data Response: {final_data_response}")
-
-        status_expr = parse('$.status')
-        dly_expr = parse('$.data.dly')
-        soc_expr = parse('$.data.soc')
-        first_flow_expr = parse('$.data.flow[0]')
+    except Exception as e:
+        log_flow.exception("Unexpected error: %s", e)
+        return False
 
-        status = [match.value for match in status_expr.find(final_data_response)]
-        if not status or status[0] != "0":
-            debug_print(f"Failed to retrieve final data: {final_data_response.get('message', 'Unknown error')}")
-            return
 
-        dly = [match.value for match in dly_expr.find(final_data_response)]
-        if dly and dly[0] == 10000:
-            debug_print("Received response with dly: 10000, requesting a new URI.")
-            #global request_interval_seconds
-            #request_interval_seconds = max(15, dly[0] / 1000)
-            #debug_print(f"new request_interval_seconds: {request_interval_seconds}")
-            global uri
-            uri = None
-            return
+# Function to handle the final request logic
+def fetch_station_data(stationtoken, station, day=None):
+    """
+    Requests the station data (real_g_c), of today or of one day (YYYY-MM-DD) given as
+    start_date/end_date. Returns the decoded response (None on errors) and whether it changed
+    since the last request.
+    """
+    station_data = {"sid": station["sid"]}
+    if day:
+        station_data.update({"start_date": day, "end_date": day})
+    headers = {'Authorization': stationtoken}
+    station_url = hoymiles_data_url + "/pvmc/api/0/station_data/real_g_c"
 
-        soc = [match.value for match in soc_expr.find(final_data_response)]
-        soc = soc[0] if soc else None
+    try:
+        station_data_response, changed = post_json("real_g_c", station_url, station_data, headers)
+    except requests.exceptions.RequestException as e:
+        log_station.error("Request failed: %s", e)
+        return None, False
+    except (json.JSONDecodeError, ValueError) as e:
+        log_station.error("JSON decoding error: %s", e)
+        return None, False
+    if not changed:
+        return station_data_response, False
+
+    log_station.debug("Station Data Response: %s", station_data_response)
+
+    fields = extract_fields("station", station_data_response)
+    if fields["status"] != "0":
+        check_token_error(station_data_response)
+        log_station.warning("Failed to retrieve station data: %s", station_data_response.get('message', 'Unknown error'))
+        return None, False
+    return station_data_response, True
+
+def get_station_data(stationtoken, station):
+    try:
+        station_data_response, changed = fetch_station_data(stationtoken, station)
+        if station_data_response is None:
+            return False
 
-        first_flow = [match.value for match in first_flow_expr.find(final_data_response)]
-        first_flow = first_flow[0] if first_flow else None
+        mqtt_topic_station = station["topic"] + "/station"
+        if not changed and publish_unchanged(mqtt_topic_station):
+            log_station.debug("Station data unchanged.")
+            return True
 
-        if soc is None or not first_flow:
-            debug_print("SOC or flow data not found.")
-            return
+        anchor_energy(station, station_data_response)
+        values = extract_sensors("station", station_data_response)
+        emit_record(station, "station", values)
+        publish_feed(station, mqtt_topic_station, station_data_response, values)
 
-        mqtt_topic_flow = mqtt_topic + "/flow"
-        publish_mqtt(mqtt_topic_flow, json.dumps(final_data_response))
-
-        i = first_flow.get("i")
-        o = first_flow.get("o")
-        v = first_flow.get("v")
-
-        debug_print(f"i: {i} o: {o} v: {v}")
-
-        power_battery_topic = mqtt_topic + "/power-battery"
-        power_to_battery_topic = mqtt_topic + "/power-to-battery"
-        power_from_battery_topic = mqtt_topic + "/power-from-battery"
-        soc_topic =  mqtt_topic + "/soc"
-        publish_mqtt(soc_topic, soc)
-
-        power_battery = 0
-        power_to_battery = 0
-        power_from_battery = 0
-        if i == 20 and o == 40 and v is not None:
-            power_battery = v
-            power_to_battery = v
-            power_from_battery = 0
-            # publish_mqtt(power_to_battery_topic, v)
-            # publish_mqtt(power_from_battery_topic, 0)
-        elif i == 40 and o == 20 and v is not None:
-            power_battery = -v
-            power_to_battery = 0
-            power_from_battery = v
-            # publish_mqtt(power_to_battery_topic, 0)
-            # publish_mqtt(power_from_battery_topic, v)
-        publish_mqtt(power_to_battery_topic, power_to_battery)
-        publish_mqtt(power_from_battery_topic, power_from_battery)
-        publish_mqtt(power_battery_topic, power_battery)
-        debug_print(f"SOC retrieved: {soc}  | power-battery: {power_battery} | power-to-battery: {power_to_battery} | power-from-battery: {power_from_battery}")
+        log_station.debug("Station values retrieved: %s", values)
+        return True
 
     except Exception as e:
-        debug_print(f"Unexpected error: {e}")
+        log_station.exception("Unexpected error: %s", e)
+        return False
 
 
 # Function to handle the final request logic
-def get_station_data(stationtoken, stationsid):
+def get_inverter_data(inverterToken, station, inverterId):
     try:
-        station_data = {"sid": stationsid}
-        headers = {'Authorization': stationtoken}
-        station_url = "https://eud0.hoymiles.com/pvmc/api/0/station_data/real_g_c"
+        inverter_data = {"id": inverterId,"sid": station["sid"]}
+        headers = {'Authorization': inverterToken}
+        inverter_url = hoymiles_api_url + "/pvmc/api/0/inverter/find_c"
 
+        mqtt_topic_inverter = inverter_topic(station, inverterId)
         try:
-            response_station = requests.post(station_url, json=station_data, headers=headers, timeout=10)
-            response_station.raise_for_status()  # Raise an error for 4xx/5xx responses
+            inverter_data_response, changed = post_json("find_c", inverter_url, inverter_data, headers)
         except requests.exceptions.RequestException as e:
-            debug_print(f"Request failed: {e}")
-            return
-
-        try:
-            station_data_response = json.loads(response_station.text)
+            log_inverter.error("Request failed: %s", e)
+            return False
         except (json.JSONDecodeError, ValueError) as e:
-            debug_print(f"JSON decoding error: {e}")
-            return
+            log_inverter.error("JSON decoding error: %s", e)
+            return False
+        if not changed and publish_unchanged(mqtt_topic_inverter):
+            log_inverter.debug("Inverter data unchanged.")
+            return True
 
-        debug_print(f"Station Data Response: {station_data_response}")
+        log_inverter.debug("Inverter Data Response: %s", inverter_data_response)
 
-        status_expr = parse('$.status')
-        bms_in_eq_expr = parse('$.data.reflux_station_data.bms_in_eq')
-        bms_out_eq_expr = parse('$.data.reflux_station_data.bms_out_eq')
+        fields = extract_fields("inverter", inverter_data_response)
+        if fields["status"] != "0":
+            check_token_error(inverter_data_response)
+            log_inverter.warning("Failed to retrieve inverter data: %s", inverter_data_response.get('message', 'Unknown error'))
+            return False
 
+        inverter_values = extract_sensors("inverter", inverter_data_response)
+        emit_record(station, "inverter", inverter_values, inverterId)
+        values = {inverter_sensor_id(station, inverterId, sensor_id): value for sensor_id, value in inverter_values.items()}
 
-        status = [match.value for match in status_expr.find(station_data_response)]
-        if not status or status[0] != "0":
-            debug_print(f"Failed to retrieve station data: {station_data_response.get('message', 'Unknown error')}")
-            return
+        publish_feed(station, mqtt_topic_inverter, inverter_data_response, values)
+        log_inverter.debug("Inverter values retrieved: %s", values)
+        return True
 
-        bms_in_eq = [match.value for match in bms_in_eq_expr.find(station_data_response)]
-        bms_in_eq = bms_in_eq[0] if bms_in_eq else None
+    except Exception as e:
+        log_inverter.exception("Unexpected error: %s", e)
+        return False
+
+
+# Station settings which can be changed through mqtt_topic/set/<name> (station_ctl requests in hoymiles-api/)
+SETTINGS = {
+    "grid-charge": {
+        "action": 1503,
+        "key": "enable",
+        "write": lambda sid, value: {"enable": 1, "sid": sid, "target": 2, "type": 1} if value else {"enable": 0, "sid": sid},
+        "state": lambda value: "ON" if int(value) else "OFF"
+    },
+    "grid-power": {
+        "action": 1513,
+        "key": "power",
+        "write": lambda sid, value: {"power": value, "sid": sid},
+        "state": lambda value: str(int(float(value)))
+    }
+}
+
+def parse_command(name, payload):
+    """ Returns the value of a command payload (ON/OFF or watts), None if it is invalid. """
+    payload = payload.strip().upper()
+    if name == "grid-charge":
+        if payload in ("ON", "1", "TRUE"):
+            return True
+        if payload in ("OFF", "0", "FALSE"):
+            return False
+        return None
+    try:
+        power = int(float(payload))
+    except (ValueError, OverflowError):  # OverflowError: inf, 1e999
+        return None
+    return power if 0 <= power <= grid_power_max else None
+
+def post_station_ctl(endpoint, token, body, timeout=None):
+    """ Posts to station_ctl/<endpoint>, returns the decoded response or None if it failed. """
+    url = hoymiles_api_url + "/pvmc/api/0/station_ctl/" + endpoint
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Authorization': token
+    }
+    try:
+        response = http_post(endpoint, url, body, headers, timeout)
+        response.raise_for_status()  # Raise an error for 4xx/5xx responses
+    except requests.exceptions.RequestException as e:
+        log_control.error("Request failed: %s", e)
+        return None
 
-        bms_out_eq = [match.value for match in bms_out_eq_expr.find(station_data_response)]
-        bms_out_eq = bms_out_eq[0] if bms_out_eq else None
+    try:
+        data = json.loads(response.text)
+    except (json.JSONDecodeError, ValueError) as e:
+        log_control.error("JSON decoding error: %s", e)
+        return None
 
-        mqtt_topic_station = mqtt_topic + "/station"
-        publish_mqtt(mqtt_topic_station, json.dumps(station_data_response))
+    log_control.debug("%s Response: %s", endpoint, data)
+    if data.get("status") != "0":
+        check_token_error(data)
+        log_control.warning("%s failed: %s", endpoint, data.get('message', 'Unknown error'))
+        return None
+    return data
 
-        debug_print(f"bms_in_eq retrieved: {bms_in_eq}  | bms_out_eq: {bms_out_eq}")
+def read_setting(token, station, name, attempts=5, timeout=None):
+    """
+    Reads a setting from the device: read_c returns a request id, setting_status_c
+    the value as soon as the device answered. Returns the value or None.
+    With timeout no request is started (or runs) after timeout seconds.
+    """
+    deadline = time.monotonic() + (timeout or attempts * (1 + 2 * http_timeout_seconds))
 
-    except Exception as e:
-        debug_print(f"Unexpected error: {e}")
+    def remaining():
+        return min(http_timeout_seconds, deadline - time.monotonic())
 
+    setting = SETTINGS[name]
+    request = post_station_ctl("read_c", token, {"action": setting["action"], "data": {"sid": station["sid"]}}, remaining())
+    if request is None or not request.get("data"):
+        return None
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(1)
+        if remaining() <= 0:
+            break
+        status = post_station_ctl("setting_status_c", token, {"id": request["data"]}, remaining())
+        values = ((status or {}).get("data") or {}).get("data")
+        if isinstance(values, dict) and setting["key"] in values:
+            return values[setting["key"]]
+    log_control.warning("No answer for %s of sid %s.", name, station["sid"])
+    return None
+
+def publish_setting(station, name, value):
+    publish_mqtt(f"{station['topic']}/{name}", SETTINGS[name]["state"](value), True)
+
+def refresh_setting(token, station, name):
+    value = read_setting(token, station, name, timeout=station_deadline_seconds)
+    if value is None:
+        return False
+    publish_setting(station, name, value)
+    return True
+
+def write_setting(token, station, name, value):
+    """ Writes a setting, returns True if the cloud accepted it (see CommandDispatcher.send for the read-back). """
+    setting = SETTINGS[name]
+    if post_station_ctl("write_c", token, {"action": setting["action"], "data": setting["write"](station["sid"], value)}) is None:
+        return False
+    log_control.info("%s of sid %s set to %s.", name, station["sid"], setting["state"](value))
+    return True
 
-# Function to handle the final request logic
-def get_inverter_data(inverterToken, inverterSid, inverterId):
-    try:
-        inverter_data = {"id": inverterId,"sid": inverterSid}
-        headers = {'Authorization': inverterToken}
-        inverter_url = "https://neapi.hoymiles.com/pvmc/api/0/inverter/find_c"
 
+def exponential_backoff(attempt):
+    # half fixed, half random, so failed processes do not retry in lockstep
+    backoff = min(max_backoff_seconds, 2 ** attempt)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+async def run_with_deadline(name, deadline, func, *args):
+    """
+    Runs a blocking fetch in a worker thread and stops waiting for it after deadline seconds.
+    The number of fetches running at the same time is bounded by poll_workers.
+    :param name: name of the fetch for debug output
+    :param deadline: seconds to wait for the fetch
+    :param func: fetch function, e.g. get_flow_data
+    """
+    async with poll_semaphore:
+        start = time.monotonic()
         try:
-            inverter_response = requests.post(inverter_url, json=inverter_data, headers=headers, timeout=10)
-            inverter_response.raise_for_status()  # Raise an error for 4xx/5xx responses
-        except requests.exceptions.RequestException as e:
-            debug_print(f"Request failed: {e}")
-            return
+            result = await asyncio.wait_for(asyncio.to_thread(func, *args), timeout=deadline)
+            log_poll.debug("%s finished in %.0f ms", name, (time.monotonic() - start) * 1000)
+            return result
+        except asyncio.TimeoutError:
+            log_poll.warning("%s did not finish within %s seconds.", name, deadline)
+        except Exception as e:
+            log_poll.error("%s failed: %s", name, e)
+        return None
+
+
+# the token cache files are opened without following symlinks (the flag does not exist on Windows)
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
 
+class SharedTokenCache:
+    """
+    Token file shared by all bridge processes of one account. A login runs under an exclusive
+    lock of <file>.lock: the first process logs in and writes the token, the others wait for
+    the lock and take the new token from the file instead of logging in themselves.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """ Returns (token, issued_at unix time) from the file or (None, None). """
         try:
-            inverter_data_response = json.loads(inverter_response.text)
-        except (json.JSONDecodeError, ValueError) as e:
-            debug_print(f"JSON decoding error: {e}")
-            return
+            with os.fdopen(os.open(self.path, os.O_RDONLY | O_NOFOLLOW), "r") as file:
+                saved = json.load(file)
+            return saved["token"], float(saved["issued_at"])
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_auth.warning("Could not read token cache %s: %s", self.path, e)
+            return None, None
+
+    def write(self, token, issued_at):
+        temp_path = None
+        try:
+            # new file with a random name (O_EXCL, mode 0600), a planted file or symlink is never written to
+            fd, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.", suffix=".tmp",
+                                             dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, "w") as file:
+                json.dump({"token": token, "issued_at": issued_at}, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log_auth.warning("Could not write token cache %s: %s", self.path, e)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def login(self, current_token):
+        """
+        Returns (token, issued_at): a token another process got after current_token
+        (or if there is none), otherwise a new one from request_new_token.
+        """
+        try:
+            lock_file = os.fdopen(os.open(f"{self.path}.lock", os.O_WRONLY | os.O_APPEND | os.O_CREAT | O_NOFOLLOW, 0o600), "a")
+        except OSError as e:
+            log_auth.warning("Could not open token cache lock, logging in without it: %s", e)
+            return request_new_token(), time.time()
+        with lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            token, issued_at = self.read()
+            if token and token != current_token and time.time() - issued_at < token_refresh_seconds:
+                log_auth.info("Using the token from %s.", self.path)
+                metrics.inc("hoymiles_shared_token_total", {"result": "reused"})
+                return token, issued_at
+            token, issued_at = request_new_token(), time.time()
+            if token:
+                metrics.inc("hoymiles_shared_token_total", {"result": "login"})
+                self.write(token, issued_at)
+            return token, issued_at
+            # the lock is released when the file is closed
+
+token_cache = SharedTokenCache(token_cache_file) if token_cache_file else None
+
+def login(current_token=None):
+    """ Returns (token, issued_at unix time) through the shared token cache, if configured. """
+    if token_cache is None:
+        return request_new_token(), time.time()
+    return token_cache.login(current_token)
+
+
+class CredentialManager:
+    """
+    Keeps the token and the burst uri of every station valid.
+    Both are renewed in the background when they reach their refresh age or when
+    a request reported them as failed. Until a new one arrives the pollers keep
+    using the current one, so a re-login does not leave a gap in the data.
+    """
 
-        debug_print(f"Inverter Data Response: {inverter_data_response}")
+    def __init__(self):
+        self.token = None
+        self.token_issued = None
+        self.token_stale = False
+        self.token_failures = 0
+        self.token_refreshes = 0
+        self.token_next_attempt = 0
+        self.uris = {}
+
+    def restore(self):
+        """ Restores token and uris from the state file (or a token from the config of older versions). """
+        now, wall_now = time.monotonic(), time.time()
+        saved = state.get("token")
+        if saved:
+            self.token = saved.get("token")
+            self.token_issued = now - max(0, wall_now - saved.get("issued_at", wall_now))
+        elif get_config_var("token", None):
+            self.token = get_config_var("token", None)
+            self.token_issued = now
+        if token_cache is not None:
+            # another process may have logged in since this one saved its token
+            shared_token, shared_issued_at = token_cache.read()
+            own_issued_at = wall_now - (now - self.token_issued) if self.token else 0
+            if shared_token and shared_issued_at > own_issued_at:
+                self.token = shared_token
+                self.token_issued = now - max(0, wall_now - shared_issued_at)
+        for sid, saved_uri in (state.get("uris") or {}).items():
+            sid = normalize_id(sid)
+            self.track_uri(sid)
+            self.uris[sid].update({
+                "uri": saved_uri.get("uri"),
+                "issued": now - max(0, wall_now - saved_uri.get("issued_at", wall_now))
+            })
+
+    def save(self):
+        wall_offset = time.time() - time.monotonic()
+        if self.token:
+            state.set("token", {"token": self.token, "issued_at": self.token_issued + wall_offset})
+        state.set("uris", {str(sid): {"uri": entry["uri"], "issued_at": entry["issued"] + wall_offset}
+                           for sid, entry in self.uris.items() if entry["uri"]})
+
+    def get_token(self):
+        return self.token
+
+    def get_uri(self, sid):
+        entry = self.uris.get(sid)
+        return entry["uri"] if entry else None
+
+    def track_uri(self, sid):
+        self.uris.setdefault(sid, {"uri": None, "issued": None, "stale": False, "failures": 0, "refreshes": 0, "next_attempt": 0})
+
+    def report_token_failure(self):
+        self.token_stale = True
+
+    def report_uri_failure(self, sid):
+        if sid in self.uris:
+            self.uris[sid]["stale"] = True
+
+    async def wait_for_token(self):
+        while not self.token:
+            await asyncio.sleep(1)
+        return self.token
+
+    async def wait_for_uri(self, sid, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.get_uri(sid) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        return self.get_uri(sid)
+
+    def stats(self):
+        return {
+            "token_age": round(time.monotonic() - self.token_issued) if self.token_issued else None,
+            "token_refreshes": self.token_refreshes,
+            "token_failures": self.token_failures,
+            "uris": {sid: {"age": round(time.monotonic() - entry["issued"]) if entry["issued"] else None,
+                           "refreshes": entry["refreshes"], "failures": entry["failures"]}
+                     for sid, entry in self.uris.items()}
+        }
+
+    def token_due(self, now):
+        if now < self.token_next_attempt:
+            return False
+        return not self.token or self.token_stale or now - self.token_issued >= token_refresh_seconds
+
+    def uri_due(self, entry, now):
+        if now < entry["next_attempt"] or not self.token:
+            return False
+        return not entry["uri"] or entry["stale"] or now - entry["issued"] >= uri_refresh_seconds
+
+    async def refresh_token(self):
+        log_auth.info("Refreshing token." if self.token else "No token found. Requesting a new one.")
+        new_token, issued_at = await asyncio.to_thread(login, self.token)
+        now = time.monotonic()
+        if new_token:
+            self.token = new_token
+            self.token_issued = now - max(0, time.time() - issued_at)
+            self.token_stale = False
+            self.token_failures = 0
+            self.token_refreshes += 1
+            metrics.inc("hoymiles_token_refreshes_total")
+            self.save()
+        else:
+            self.token_failures += 1
+            metrics.inc("hoymiles_token_refresh_failures_total")
+            self.token_next_attempt = now + exponential_backoff(self.token_failures)
+
+    async def refresh_uri(self, sid, entry):
+        log_auth.info("Refreshing uri for sid %s." if entry["uri"] else "No uri found for sid %s. Requesting a new one.", sid)
+        new_uri = await asyncio.to_thread(get_uri, self.token, sid)
+        now = time.monotonic()
+        if new_uri:
+            entry.update({"uri": new_uri, "issued": now, "stale": False, "failures": 0, "next_attempt": 0})
+            entry["refreshes"] += 1
+            metrics.inc("hoymiles_uri_refreshes_total", {"sid": sid})
+            self.save()
+        else:
+            entry["failures"] += 1
+            metrics.inc("hoymiles_uri_refresh_failures_total", {"sid": sid})
+            entry["next_attempt"] = now + exponential_backoff(entry["failures"])
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            if self.token_due(now):
+                await self.refresh_token()
+            due = [(sid, entry) for sid, entry in self.uris.items() if self.uri_due(entry, time.monotonic())]
+            if due:
+                await asyncio.gather(*(self.refresh_uri(sid, entry) for sid, entry in due))
+            await asyncio.sleep(1)
 
-        status_expr = parse('$.status')
-        bms_temp_expr = parse('$.data.real_data.bms_temp')
+credentials = CredentialManager()
+credentials.restore()
 
 
-        status = [match.value for match in status_expr.find(inverter_data_response)]
-        if not status or status[0] != "0":
-            debug_print(f"Failed to retrieve inverter data: {inverter_data_response.get('message', 'Unknown error')}")
+class CommandDispatcher:
+    """
+    Sends the MQTT commands per station and setting. A command is written after
+    command_debounce_seconds without a newer one, so of a burst of setpoints only
+    the latest is sent. Commands arriving during a write are sent right after it.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.pending = {}  # (sid, name) -> (station, value)
+        self.timers = {}
+        self.running = {}
+
+    def submit(self, station, name, value):
+        """ Hands a command from the paho network thread to the poll loop. """
+        if self.loop is None:
+            log_control.warning("Poll loop not running yet, ignoring %s command.", name)
             return
+        self.loop.call_soon_threadsafe(self.schedule, station, name, value)
+
+    def schedule(self, station, name, value):
+        key = (station["sid"], name)
+        if key in self.pending:
+            metrics.inc("hoymiles_commands_total", {"setting": name, "result": "coalesced"})
+        self.pending[key] = (station, value)
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self.timers[key] = self.loop.call_later(command_debounce_seconds, self.start, key)
+
+    def start(self, key):
+        del self.timers[key]
+        if key not in self.running:
+            self.running[key] = self.loop.create_task(self.send(key))
+
+    async def send(self, key):
+        sid, name = key
+        try:
+            while key in self.pending and key not in self.timers:
+                station, value = self.pending.pop(key)
+                await credentials.wait_for_token()
+                written = await run_with_deadline(f"{name} {sid}", station_deadline_seconds, write_setting, credentials.get_token(), station, name, value)
+                metrics.inc("hoymiles_commands_total", {"setting": name, "result": "sent" if written else "failed"})
+                if not written:
+                    continue
+                # the write is done, a slow read-back only delays the confirmation
+                publish_setting(station, name, value)
+                flow_schedule = station.get("schedules", {}).get("flow")
+                if flow_schedule is not None:
+                    # the next flow sample shows the effect of the new setting
+                    flow_schedule.trigger()
+                confirmed = await run_with_deadline(f"{name} {sid} read-back", command_confirm_seconds + http_timeout_seconds,
+                                                    read_setting, credentials.get_token(), station, name, 5, command_confirm_seconds)
+                metrics.inc("hoymiles_commands_total", {"setting": name, "result": "unconfirmed" if confirmed is None else "confirmed"})
+                if confirmed is not None:
+                    publish_setting(station, name, confirmed)
+        finally:
+            del self.running[key]
+
+commands = CommandDispatcher()
+
+
+async def refresh_settings(station):
+    """ Publishes the current settings of a station once, afterwards they are read back after every command. """
+    await credentials.wait_for_token()
+    for name in SETTINGS:
+        await run_with_deadline(f"{name} {station['sid']}", station_deadline_seconds, refresh_setting, credentials.get_token(), station, name)
+
+
+def subscribe_commands(client):
+    # after every connect, single station: mqtt_topic/set/<name>, several: mqtt_topic/<sid>/set/<name>
+    client.subscribe([(f"{mqtt_topic}/set/+", 0), (f"{mqtt_topic}/+/set/+", 0)])
+
+def handle_command(message):
+    station_topic, _, name = message.topic.rpartition("/set/")
+    station = next((station for station in stations if station["topic"] == station_topic), None)
+    if station is None or name not in SETTINGS:
+        return
+    if message.retain:
+        # a retained command would be applied again on every start
+        log_control.warning("Ignoring retained command on %s.", message.topic)
+        return
+    payload = message.payload.decode("utf-8", "replace")
+    value = parse_command(name, payload)
+    if value is None:
+        log_control.warning("Invalid command '%s' on %s.", payload, message.topic)
+        metrics.inc("hoymiles_commands_total", {"setting": name, "result": "invalid"})
+        return
+    log_control.debug("Command %s=%s for sid %s.", name, value, station["sid"])
+    metrics.inc("hoymiles_commands_total", {"setting": name, "result": "received"})
+    commands.submit(station, name, value)
+
+def on_mqtt_message(client, userdata, message):
+    if message.topic == f"{discovery_prefix}/status":
+        # birth message of Home Assistant (a retained one arrives on every connect, it is covered by the reconnect)
+        if message.payload == b"online" and not message.retain:
+            discovery.republish()
+        return
+    if enable_commands:
+        try:
+            handle_command(message)
+        except Exception as e:
+            # an exception would end the network thread of paho, no command may stop the bridge
+            log_control.exception("Unexpected error in command on %s: %s", message.topic, e)
 
-        bms_temp = [match.value for match in bms_temp_expr.find(inverter_data_response)]
-        bms_temp = bms_temp[0] if bms_temp else None
 
-        mqtt_topic_station = mqtt_topic + "/inverter"
-        publish_mqtt(mqtt_topic_station, json.dumps(inverter_data_response))
-        debug_print(f"bms_temp retrieved: {bms_temp}")
+class FeedSchedule:
+    """
+    Fixed-rate schedule of one data feed on the monotonic clock.
+    Ticks stay on a fixed grid (start + n * interval), so the request time does not add up
+    to a drift. A server delay hint pushes the next tick back, errors back off exponentially.
+    """
 
+    def __init__(self, feed, key, interval, topic):
+        self.feed = feed
+        self.key = key
+        self.name = f"{feed} {key}"
+        self.interval = max(1, interval)
+        self.availability_topic = f"{topic}/availability"
+        self.failures = 0
+        self.last_success = None
+        self.last_sample = None  # unix time of the last good sample, kept in sample_state_file
+        self.hint = 0  # last server delay hint, the feed is not polled faster
+        self.fresh = None  # last published availability
+        self.base_due = time.monotonic()
+        self.next_due = self.base_due
+        self.wakeup = asyncio.Event()
+
+    def delay(self):
+        return max(0.0, self.next_due - time.monotonic())
+
+    def lag(self):
+        """ Seconds the current tick started behind schedule. """
+        return max(0.0, time.monotonic() - self.next_due)
+
+    def success(self, hint_seconds=None):
+        """ A sample was decoded and published. """
+        self.last_success = time.monotonic()
+        self.last_sample = time.time()
+        self.retry(hint_seconds)
+
+    def retry(self, hint_seconds=None):
+        """ The cloud answered without data (e.g. dly 10000), only its delay hint is applied. """
+        self.failures = 0
+        now = time.monotonic()
+        self.hint = hint_seconds or 0
+        self.base_due += self.interval
+        if self.base_due <= now:
+            # skip the ticks we missed instead of firing them in a burst
+            missed = int((now - self.base_due) // self.interval) + 1
+            self.base_due += missed * self.interval
+        if hint_seconds and now + hint_seconds > self.base_due:
+            self.base_due = now + hint_seconds
+        self.next_due = self.base_due + random.uniform(0, poll_jitter_seconds)
+
+    def failure(self):
+        self.failures += 1
+        backoff = min(max_backoff_seconds, self.interval * (2 ** (self.failures - 1)))
+        self.base_due = time.monotonic() + backoff
+        self.next_due = self.base_due + random.uniform(0, poll_jitter_seconds)
+        log_poll.warning("%s failed %s time(s), next try in %s seconds.", self.name, self.failures, backoff)
+
+    def trigger(self):
+        """ Makes the feed due now, e.g. after a write command. """
+        self.base_due = time.monotonic()
+        self.next_due = self.base_due
+        self.wakeup.set()
+
+    async def wait(self):
+        """ Sleeps until the feed is due or triggered. """
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), self.delay())
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
 
-    except Exception as e:
-        debug_print(f"Unexpected error: {e}")
 
+async def fetch_flow(station):
+    """ Fetches the flow data of a station with the current burst uri. """
+    if not await credentials.wait_for_uri(station["sid"], flow_deadline_seconds):
+        log_flow.warning("No uri for sid %s yet, no final request!", station['sid'])
+        return False
+    return await run_with_deadline(f"flow {station['sid']}", flow_deadline_seconds, get_flow_data, credentials.get_token(), station)
 
-def exponential_backoff(attempt):
-    return min(60, (2 ** attempt))
 
-# Main logic
-try:
-    token_request_attempts = 0
-    publish_discovery()
+async def run_feed(schedule, fetch, station=None):
+    """
+    Runs one feed on its own cadence.
+    :param schedule: FeedSchedule of the feed
+    :param fetch: coroutine function doing the fetch, returns True on success and "retry" for an answer without data
+    :param station: station of a flow feed, its dly hint is honoured
+    """
     while True:
-        current_time = time.time()
-        
-        if not token:
-            debug_print("No token found. Requesting a new one.")
-            token = request_new_token()
-            if not token:
-                time.sleep(exponential_backoff(token_request_attempts))
-                token_request_attempts += 1
+        await schedule.wait()
+        await credentials.wait_for_token()
+        lag = schedule.lag()
+        metrics.observe("hoymiles_poll_lag_seconds", {"feed": schedule.feed}, lag)
+        if lag > 1:
+            log_poll.info("%s started %.1f seconds behind schedule.", schedule.name, lag)
+        result = await fetch()
+        if result:
+            hint = station.pop("dly", None) if station is not None else None
+            if result == "retry":
+                schedule.retry(hint)
             else:
-                token_request_attempts = 0
-
-        if token and not sid:
-            debug_print("No sid found. Requesting a new one.")
-            sid = get_sid(token)
-        
-        if token and sid:
-            if not uri:
-                debug_print("No uri found. Requesting a new one.")
-                uri = get_uri(token, sid)
-            if uri:
-                debug_print("Using cached uri.")
-
-                get_flow_data(token, sid, uri)
-                
-                # Call get_station_data every 1 hour
-                if current_time - last_station_data_time >= station_data_interval:
-                    get_station_data(token, sid)
-                    if inverterId:
-                        get_inverter_data(token, sid, inverterId)
-                    else:
-                        debug_print("no inverterID")
-                    last_station_data_time = current_time
-            else:
-                debug_print("No uri, no final request!")
+                schedule.success(hint)
+        else:
+            metrics.inc("hoymiles_feed_failures_total", {"feed": schedule.feed, "id": schedule.key})
+            schedule.failure()
+
+
+def collect_feed_metrics():
+    now = time.monotonic()
+    return [("hoymiles_last_success_age_seconds", {"feed": schedule.feed, "id": schedule.key}, round(now - schedule.last_success, 1))
+            for station in stations for schedule in station.get("schedules", {}).values()
+            if schedule.last_success is not None]
+
+metrics.add_collector(collect_feed_metrics)
+
+
+def feed_freshness(stations):
+    """ Returns the last good sample (unix time) and the availability of every feed, for the stats topic. """
+    return {schedule.name: {"last_sample": round(schedule.last_sample) if schedule.last_sample else None, "fresh": bool(schedule.fresh)}
+            for station in stations for schedule in station.get("schedules", {}).values()}
+
+def update_feed_availability(stations):
+    """
+    Publishes online/offline to the availability topic of every feed whose freshness changed.
+    A feed is fresh while its last good sample is younger than stale_after_intervals intervals.
+    """
+    now = time.time()
+    for station in stations:
+        for schedule in station.get("schedules", {}).values():
+            fresh = schedule.last_sample is not None and now - schedule.last_sample <= stale_seconds(max(schedule.interval, schedule.hint))
+            if fresh == schedule.fresh:
+                continue
+            if schedule.fresh and not fresh:
+                log_poll.warning("%s is stale, no good sample for %.0f seconds.", schedule.name, now - schedule.last_sample)
+            elif schedule.fresh is False and fresh:
+                log_poll.info("%s is available.", schedule.name)
+            schedule.fresh = fresh
+            publish_mqtt(schedule.availability_topic, "online" if fresh else "offline", True)
+    sample_state.set("last_samples", {schedule.name: schedule.last_sample for station in stations
+                                       for schedule in station.get("schedules", {}).values() if schedule.last_sample})
+
+def collect_freshness_metrics():
+    return [("hoymiles_feed_fresh", {"feed": schedule.feed, "id": schedule.key}, 1 if schedule.fresh else 0)
+            for station in stations for schedule in station.get("schedules", {}).values()]
+
+metrics.add_collector(collect_freshness_metrics)
+
+
+def start_feeds(stations):
+    """ Starts one task per feed: flow and station data per station, inverter data per device. """
+    tasks = []
+    last_samples = sample_state.get("last_samples") or {}
+    for station in stations:
+        sid = station["sid"]
+        credentials.track_uri(sid)
+        station["schedules"] = {
+            "flow": FeedSchedule("flow", sid, request_interval_seconds, f"{station['topic']}/flow"),
+            "station": FeedSchedule("station", sid, station_data_interval, f"{station['topic']}/station")
+        }
+        tasks.append(asyncio.create_task(run_feed(station["schedules"]["flow"], lambda station=station: fetch_flow(station), station)))
+        tasks.append(asyncio.create_task(run_feed(
+            station["schedules"]["station"],
+            lambda station=station: run_with_deadline(f"station {station['sid']}", station_deadline_seconds, get_station_data, credentials.get_token(), station))))
+        if not station["inverter_ids"]:
+            log_inverter.info("no inverterID for sid %s", sid)
+        for inverter_id in station["inverter_ids"]:
+            schedule = FeedSchedule("inverter", inverter_id, inverter_data_interval, inverter_topic(station, inverter_id))
+            station["schedules"][f"inverter {inverter_id}"] = schedule
+            tasks.append(asyncio.create_task(run_feed(
+                schedule,
+                lambda station=station, inverter_id=inverter_id: run_with_deadline(f"inverter {inverter_id}", inverter_deadline_seconds, get_inverter_data, credentials.get_token(), station, inverter_id))))
+        # a restart does not make the feeds stale if their last samples are recent
+        for schedule in station["schedules"].values():
+            schedule.last_sample = last_samples.get(schedule.name)
+    return tasks
+
+def station_keys(stations):
+    return [(station["sid"], tuple(station["inverter_ids"])) for station in stations]
+
+
+async def poll_loop():
+    """
+    Main loop. Keeps the station list valid and runs every feed (flow, station,
+    inverter) of every station as its own task. Token and burst uris are kept
+    valid by the credential manager in the background. The fetches run concurrently
+    through a bounded worker pool (poll_workers), MQTT publishing is handed to the
+    paho network thread and does not block the loop.
+    """
+    global stations, poll_semaphore
+    poll_semaphore = asyncio.Semaphore(poll_workers)
+    commands.loop = asyncio.get_running_loop()
+    publisher.start()
+    publish_startup(stations)
+    background_tasks.update(asyncio.create_task(job) for job in (warm_up(), credentials.run(), state.run(), sample_state.run()))
+    if sample_buffer is not None:
+        background_tasks.add(asyncio.create_task(sample_buffer.run()))
+    discovery_attempts = 0
+    last_stats_time = time.monotonic()
+    last_station_refresh = time.monotonic()
+    feed_tasks = []
+    while True:
+        if not stations:
+            await credentials.wait_for_token()
+            log_station.info("No sid found. Requesting a new one.")
+            stations = await asyncio.to_thread(get_stations, credentials.get_token()) or []
+            if not stations:
+                await asyncio.sleep(exponential_backoff(discovery_attempts))
+                discovery_attempts += 1
+                continue
+            discovery_attempts = 0
+
+        if not feed_tasks:
+            for station in stations:
+                publish_discovery(station)
+            feed_tasks = start_feeds(stations)
+            if enable_commands:
+                feed_tasks.extend(asyncio.create_task(refresh_settings(station)) for station in stations)
+
+        if station_refresh_seconds > 0 and time.monotonic() - last_station_refresh >= station_refresh_seconds:
+            last_station_refresh = time.monotonic()
+            found = await asyncio.to_thread(get_stations, credentials.get_token())
+            if found and station_keys(found) != station_keys(stations):
+                log_station.info("Station list changed, restarting the feeds.")
+                for task in feed_tasks:
+                    task.cancel()
+                stations, feed_tasks = found, []
+                continue
+
+        update_feed_availability(stations)
+
+        if stats_interval_seconds > 0 and time.monotonic() - last_stats_time >= stats_interval_seconds:
+            summary = metrics.summary()
+            summary["credentials"] = credentials.stats()
+            summary["feeds"] = feed_freshness(stations)
+            publish_mqtt(f"{mqtt_topic}/bridge/stats", json.dumps(summary), True)
+            last_stats_time = time.monotonic()
+
+        await asyncio.sleep(1)
+
+
+def get_station_history(token, station, day):
+    """
+    Returns the SENSORS values of the station data of one past day, or None.
+    real_g_c is asked with start_date/end_date of the day; days the cloud answers
+    with another date than the requested one are not used.
+    """
+    try:
+        response, _ = fetch_station_data(token, station, day)
+        if response is None:
+            return None
+        answered = extract_fields("station", response)["start_date"]
+        if answered != day:
+            log_station.warning("Station data for %s of sid %s answered with date %s, skipping the day.", day, station["sid"], answered)
+            return None
+        return extract_sensors("station", response)
+    except Exception as e:
+        log_station.exception("Unexpected error: %s", e)
+        return None
 
-        time.sleep(request_interval_seconds)
 
-except KeyboardInterrupt:
-    debug_print("\nScript terminated by user (Ctrl+C). Exiting gracefully.")
-    mqtt_client.disconnect()
-    mqtt_client.loop_stop()
+def statistic_id(station, sensor_id):
+    """ Entity id Home Assistant gives the sensor by default, e.g. sensor.hoymiles_ms_a2_charge_today. """
+    device_name = "Hoymiles MS-A2" if station["device_id"] == "hoymiles-ms-a2" else f"Hoymiles MS-A2 {station['sid']}"
+    return "sensor." + re.sub(r"[^a-z0-9]+", "_", f"{device_name} {SENSORS[sensor_id]['name']}".lower()).strip("_")
+
+def write_backfill(path, output_format, stations, results, start_sums=None):
+    """
+    Writes the collected days sorted by date, as InfluxDB line protocol (one line per station and day,
+    timestamp local midnight) or as CSV for the Home Assistant statistics import (one row per sensor and day).
+    The sum column of a statistic continues from start_sums (statistic id -> sum before the first day, default 0).
+    """
+    start_sums = start_sums or {}
+    with open(path, "w") as file:
+        if output_format == "ha":
+            file.write("statistic_id,unit,start,state,sum\n")
+        for station in stations:
+            days = results.get(str(station["sid"]), {})
+            sums = {}
+            for day in sorted(days):
+                numbers = {}
+                for sensor_id, value in days[day].items():
+                    try:
+                        numbers[sensor_id] = float(value)
+                    except (TypeError, ValueError):
+                        pass
+                if not numbers:
+                    continue
+                if output_format == "influx":
+                    timestamp = station_time(day)
+                    file.write(line_protocol(make_record(station, "station", numbers, timestamp=timestamp)) + "\n")
+                    continue
+                for sensor_id, number in numbers.items():
+                    if sensor_id not in sums:
+                        sums[sensor_id] = start_sums.get(statistic_id(station, sensor_id), 0.0)
+                    sums[sensor_id] += number
+                    unit = SENSORS[sensor_id].get("unit_of_measurement", "")
+                    file.write(f"{statistic_id(station, sensor_id)},{unit},{day} 00:00,{number},{sums[sensor_id]}\n")
+
+async def backfill(first_day, last_day, output, output_format, workers, start_sums=None):
+    """
+    Fetches the station data of every day from first_day to last_day (at most yesterday)
+    for all stations, workers days at the same time, and writes them to output
+    (the Home Assistant sums continue from start_sums).
+    Fetched days are kept in <output>.progress: an interrupted backfill continues where it
+    stopped and every day is requested and written only once.
+    """
+    global stations, poll_semaphore
+    poll_semaphore = asyncio.Semaphore(workers)
+    last_day = min(last_day, station_day(time.time()) - timedelta(days=1))  # today is published by the running bridge
+    days = [(first_day + timedelta(days=offset)).isoformat() for offset in range((last_day - first_day).days + 1)]
+    if not days:
+        log_station.error("No complete day between %s and %s.", first_day, last_day)
+        return False
+
+    token = credentials.get_token() or (await asyncio.to_thread(login))[0]
+    if not token:
+        log_auth.error("Login failed, no backfill.")
+        return False
+    if not stations:
+        stations = await asyncio.to_thread(get_stations, token) or []
+
+    progress = StateStore(f"{output}.progress", state_flush_seconds)  # "<sid> <day>" -> values, flushed below
+
+    async def fetch_day(station, day):
+        values = await run_with_deadline(f"backfill {station['sid']} {day}", station_deadline_seconds, get_station_history, token, station, day)
+        if values:
+            progress.set(f"{station['sid']} {day}", values)
+        return values is not None
+
+    missing = [(station, day) for station in stations for day in days if progress.get(f"{station['sid']} {day}") is None]
+    log_station.info("Backfill of %s day(s) for %s station(s), %s already fetched.", len(days), len(stations), len(days) * len(stations) - len(missing))
+    tasks = [asyncio.create_task(fetch_day(station, day)) for station, day in missing]
+    failed = 0
+    for done, task in enumerate(asyncio.as_completed(tasks), 1):
+        if not await task:
+            failed += 1
+        if done % 50 == 0:
+            await asyncio.to_thread(progress.flush)
+            log_station.info("Backfill: %s of %s day(s) fetched.", done, len(tasks))
+    progress.flush()
+
+    results = {}
+    for key, values in progress.load().items():
+        sid, day = key.split(" ", 1)
+        results.setdefault(sid, {})[day] = values
+    write_backfill(output, output_format, stations, results, start_sums)
+    log_station.info("Backfill written to %s (%s day(s) failed, run it again to retry them).", output, failed)
+    return failed == 0
+
+
+class ReplayResponse:
+    """ Captured response with the attributes the request functions read from requests.Response. """
+
+    def __init__(self, entry):
+        self.status_code = entry["status"]
+        self.text = entry["body"]
+        self.content = self.text.encode("utf-8")
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} (captured)", response=self)
+
+class ReplaySession:
+    """ Stands in for the HTTP session in the replay: answers every request with the next captured response. """
+
+    def __init__(self, entries):
+        self.entries = collections.deque(entries)
+        self.answered = 0
+
+    def peek(self):
+        return self.entries[0] if self.entries else None
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        if not self.entries:
+            raise requests.ConnectionError("end of the capture")
+        self.answered += 1
+        return ReplayResponse(self.entries.popleft())
+
+    def head(self, url, timeout=None):
+        raise requests.ConnectionError("no network access in the replay")
+
+class ReplayMqttClient:
+    """ Stands in for paho in the replay: counts the messages and writes them as json lines to output (if given). """
+
+    def __init__(self, output):
+        self.file = open(output, "w") if output else None
+        self.messages = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages += 1
+        if self.file:
+            self.file.write(json.dumps({"topic": topic, "payload": payload, "retain": retain}) + "\n")
+        return mqtt.MQTTMessageInfo(self.messages)
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class StageProfiler:
+    """
+    Times the stages of the replay (stations, flow, station, inverter, publish). With profiler
+    "cprofile" every stage has its own cProfile profile, written to <directory>/<stage>.prof
+    (pstats, snakeviz). With "sampling" a thread samples the stack of the replay every interval,
+    the stacks are written per stage in collapsed format to <directory>/<stage>.folded
+    (flamegraph.pl, speedscope).
+    """
+
+    def __init__(self, profiler, directory, interval=0.001):
+        self.profiler = profiler
+        self.directory = directory
+        self.interval = interval
+        self.durations = collections.defaultdict(list)
+        self.profiles = {}
+        self.samples = collections.defaultdict(collections.Counter)
+        self.current = None
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        if profiler == "sampling":
+            threading.Thread(target=self.sample, name="replay-sampler", daemon=True).start()
+
+    def run(self, stage, func, *args):
+        profile = None
+        if self.profiler == "cprofile":
+            if stage not in self.profiles:
+                import cProfile
+                self.profiles[stage] = cProfile.Profile()
+            profile = self.profiles[stage]
+        self.current = stage
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            return func(*args)
+        finally:
+            if profile:
+                profile.disable()
+            self.durations[stage].append(time.perf_counter() - start)
+            self.current = None
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            stage = self.current
+            frame = sys._current_frames().get(self.thread_id)
+            if stage is None or frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[stage][";".join(reversed(stack))] += 1
+
+    def report(self):
+        self.stopped.set()
+        print(f"{'stage':10} {'calls':>8} {'total ms':>10} {'mean us':>10} {'p99 us':>10}")
+        for stage, durations in self.durations.items():
+            durations = sorted(durations)
+            p99 = durations[min(len(durations) - 1, int(0.99 * len(durations)))]
+            print(f"{stage:10} {len(durations):8} {sum(durations) * 1000:10.1f} "
+                  f"{sum(durations) / len(durations) * 1e6:10.1f} {p99 * 1e6:10.1f}")
+        if self.profiler is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for stage, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory, f"{stage}.prof"))
+        for stage, stacks in self.samples.items():
+            with open(os.path.join(self.directory, f"{stage}.folded"), "w") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        print(f"{self.profiler} profiles of the stages written to {self.directory}")
+
+def read_capture(path):
+    """ Returns the responses of a capture file, of a capture cut off by a crash up to its last complete line. """
+    entries = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entries.append(json.loads(line))
+    except (EOFError, ValueError) as e:
+        log.warning("Capture %s ends early (%s), replaying the first %s response(s).", path, e, len(entries))
+    return entries
+
+def replay_station(sid, inverter_id=None):
+    """ Station of a captured request, added if the capture does not start with the station list. """
+    sid = normalize_id(sid)
+    station = next((station for station in stations if station["sid"] == sid), None)
+    if station is None:
+        station = new_station(sid, [])
+        stations.append(station)
+        assign_station_topics(stations)
+    if inverter_id is not None and inverter_id not in station["inverter_ids"]:
+        station["inverter_ids"].append(inverter_id)
+    return station
+
+def replay(path, realtime, repeat, profiler, profile_directory, output):
+    """
+    Feeds the responses of a capture (--record) through the decode and publish path of the bridge,
+    without network access and with an empty state (state and sample state file are neither read nor written).
+    The responses are replayed as fast as possible or, with realtime, with the recorded pauses;
+    the time of every stage is printed and optionally profiled (see StageProfiler).
+    """
+    global requests, mqtt, http_session, mqtt_client, stations, energy, sample_clock
+    import requests
+    import paho.mqtt.client as mqtt
+    captured = read_capture(path)
+    if not captured:
+        log.error("No responses in capture %s.", path)
+        return False
+    # every repetition continues after the last one, the live energy keeps integrating
+    span = captured[-1]["ts"] - captured[0]["ts"] + 1
+    entries = [{**entry, "ts": entry["ts"] + span * run} for run in range(repeat) for entry in captured]
+
+    state.data = {}
+    sample_state.data = {}
+    stations = []
+    energy = EnergyIntegrator()
+    session = http_session = ReplaySession(entries)
+    mqtt_client = ReplayMqttClient(output)
+    for sink in sinks:
+        sink.start()
+    stages = StageProfiler(profiler, profile_directory)
+    first_ts, started, skipped = entries[0]["ts"], time.monotonic(), 0
+    while session.entries:
+        entry = session.peek()
+        if realtime:
+            time.sleep(max(0, entry["ts"] - first_ts - (time.monotonic() - started)))
+        sample_clock = lambda entry=entry: entry["ts"]
+        request = entry["request"] or {}
+        answered = session.answered
+        if entry["endpoint"] == "select_by_page_c":
+            stations = stages.run("stations", get_stations, "replay") or stations
+        elif entry["endpoint"] == "flow":
+            stages.run("flow", get_flow_data, "replay", replay_station(request.get("sid")))
+        elif entry["endpoint"] == "real_g_c" and not request.get("start_date"):
+            stages.run("station", get_station_data, "replay", replay_station(request.get("sid")))
+        elif entry["endpoint"] == "find_c":
+            inverter_id = request.get("id")
+            stages.run("inverter", get_inverter_data, "replay", replay_station(request.get("sid"), inverter_id), inverter_id)
+        if session.answered == answered:
+            # not requested, e.g. answered by the response cache
+            session.entries.popleft()
+            skipped += 1
+        stages.run("publish", publisher.drain)
+    for sink in sinks:
+        sink.stop(30)
+    mqtt_client.close()
+    print(f"{len(entries)} response(s) replayed in {time.monotonic() - started:.2f} s, "
+          f"{skipped} not requested (response cache), {mqtt_client.messages} message(s) published")
+    stages.report()
+    return True
+
+
+def parse_start_sum(text):
+    """ Parses a --start-sum argument (statistic id=sum). """
+    statistic, _, number = text.partition("=")
+    try:
+        return statistic.strip(), float(number)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected STATISTIC_ID=SUM, got {text!r}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hoymiles MS-A2 cloud to MQTT bridge")
+    parser.add_argument("--backfill", nargs=2, metavar=("FROM", "TO"), type=date.fromisoformat,
+                        help="fetch the station data of the days FROM..TO (YYYY-MM-DD) instead of running the bridge")
+    parser.add_argument("--format", choices=("influx", "ha"), default="influx",
+                        help="backfill output: InfluxDB line protocol or CSV for the Home Assistant statistics import")
+    parser.add_argument("--output", help="backfill output file (default hoymiles-backfill.lp or .csv), "
+                                         "with --replay file for the published messages (json lines)")
+    parser.add_argument("--workers", type=int, default=poll_workers, help="days fetched at the same time")
+    parser.add_argument("--start-sum", action="append", default=[], type=parse_start_sum, metavar="STATISTIC_ID=SUM",
+                        help="with --format ha: sum of the statistic before FROM, to import into a statistic that already has data "
+                             "(repeat it for every statistic)")
+    parser.add_argument("--record", metavar="FILE", help="run the bridge and append the raw cloud responses to FILE (gzip)")
+    parser.add_argument("--replay", metavar="FILE", help="feed the responses of a --record capture through decode and publish, "
+                                                        "without network access, instead of running the bridge")
+    parser.add_argument("--realtime", action="store_true", help="replay with the recorded pauses (default: as fast as possible)")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the capture this many times")
+    parser.add_argument("--profile", choices=("cprofile", "sampling"), help="profile every stage of the replay")
+    parser.add_argument("--profile-dir", default="replay-profile", help="directory of the replay profiles")
+    return parser.parse_args()
+
+
+def stop_on_sigterm(signum, frame):
+    # docker stop sends SIGTERM, the bridge stops like on Ctrl+C and writes its state
+    raise KeyboardInterrupt
+
+def main():
+    args = parse_args()
+    if args.backfill:
+        output = args.output or ("hoymiles-backfill.csv" if args.format == "ha" else "hoymiles-backfill.lp")
+        sys.exit(0 if asyncio.run(backfill(*args.backfill, output, args.format, max(1, args.workers), dict(args.start_sum))) else 1)
+    if args.replay:
+        sys.exit(0 if replay(args.replay, args.realtime, max(1, args.repeat), args.profile, args.profile_dir, args.output) else 1)
+
+    global mqtt_client, capture, sample_buffer
+    sample_buffer = open_sample_buffer()
+    if args.record:
+        capture = CaptureWriter(args.record)
+    if metrics_port:
+        start_metrics_server()
+    mqtt_client = create_mqtt_client()
+    for sink in sinks:
+        sink.start()
+    # connects in the paho network thread, retries with backoff until the broker is reachable
+    mqtt_client.connect_async(mqtt_broker, mqtt_port, 60)
+    mqtt_client.loop_start()
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    try:
+        asyncio.run(poll_loop())
+    except KeyboardInterrupt:
+        log.info("Script terminated by user (Ctrl+C). Exiting gracefully.")
+        state.flush()
+        sample_state.flush()
+        for sink in sinks:
+            sink.stop(5)
+        if capture is not None:
+            capture.close()
+        publish_mqtt(availability_topic, "offline", True)
+        publisher.wait_empty(5)
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+
+
+if __name__ == "__main__":
+    main()